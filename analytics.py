@@ -0,0 +1,328 @@
+# Statistics over the whole corpus: who said how much in which session, how
+# the sessions compare, and how they've changed over time. The corpus is loaded
+# once into NumPy arrays, one item per entry, and every statistic is a few
+# array operations over them, rather than a loop over the entries.
+#
+# Lengths and word counts are of the text outside any markup, measured in
+# UTF-8 bytes and runs of non-space bytes respectively; entities count as they
+# are written. Only statements have players, so the per-player statistics are
+# of statements alone.
+import os
+import csv
+import json
+import codecs
+from xml.sax.saxutils import escape
+try:
+    import numpy
+except ImportError:
+    raise Exception("Corpus statistics need NumPy: pip install numpy")
+import archive
+import template
+import log_conversion
+from log_entry import TEXT, STATEMENT, EMOTE, entry_types
+
+# an archive's entry table, as a NumPy record type
+entry_dtype = numpy.dtype([("type", "<u1"), ("player", "<u2"),
+                           ("offset", "<u4"), ("length", "<u4")])
+type_count = len(entry_types)
+
+
+def measure(data, offsets, lengths):
+    """Return (text lengths, word counts) for the strings at offsets in data,
+    a uint8 array. A "<" starts markup, which continues to the next ">" or the
+    end of the string."""
+    if len(data) == 0:
+        return (numpy.zeros(len(offsets), dtype=numpy.int64),
+                numpy.zeros(len(offsets), dtype=numpy.int64))
+    positions = numpy.arange(len(data))
+    starts = numpy.zeros(len(data), dtype=bool)
+    starts[offsets[lengths > 0]] = True
+
+    # the last "<" at or before each byte, and the last ">" before it, or
+    # before the start of its string
+    last_open = numpy.maximum.accumulate(
+        numpy.where(data == ord("<"), positions, -1))
+    closes = numpy.where(data == ord(">"), positions, -1)
+    last_close = numpy.empty(len(data), dtype=positions.dtype)
+    last_close[0] = -1
+    last_close[1:] = closes[:-1]
+    last_close[starts] = positions[starts] - 1
+    last_close = numpy.maximum.accumulate(last_close)
+    text = last_open <= last_close
+
+    # a word starts at any text byte which isn't a space and doesn't follow one
+    # which isn't either
+    in_word = text & (data != ord(" ")) & (data != ord("\t")) & (
+        data != ord("\n")) & (data != ord("\r"))
+    word_starts = in_word.copy()
+    word_starts[1:] &= ~in_word[:-1]
+    word_starts[starts] = in_word[starts]
+
+    def sums(values):
+        """The sum of values over each string."""
+        totals = numpy.zeros(len(values) + 1, dtype=numpy.int64)
+        numpy.cumsum(values, out=totals[1:])
+        return totals[offsets + lengths] - totals[offsets]
+
+    return (sums(text), sums(word_starts))
+
+
+class Corpus(object):
+    """Every entry in a directory of JSON files, or an archive, as arrays:
+    chapter_codes, type_codes, player_codes (-1 for none), text_lengths and
+    word_counts. chapters and players hold the names the codes stand for."""
+
+    def __init__(self, path, exporter=None):
+        # the exporter lists and reads the chapters, so its selection applies
+        self.exporter = exporter or log_conversion.LogExporter()
+        self.chapters = []
+        self.players = []
+
+        selecting = (self.exporter.chapter_selection is not None or
+                     self.exporter.entry_range is not None or
+                     self.exporter.player_selection is not None)
+        if self.exporter.is_archive(path) and not selecting:
+            self.load_archive(self.exporter.open_archive(path),
+                              self.exporter.list_chapters(path))
+        else:
+            self.load_entries(path)
+
+    def load_archive(self, corpus_archive, chapters):
+        """Take the arrays straight from the archive's tables, without decoding
+        any entries. chapters are the archive's chapter names, in the order
+        they're listed."""
+        entries = numpy.frombuffer(corpus_archive.data, dtype=entry_dtype,
+                                   count=corpus_archive.entry_count,
+                                   offset=corpus_archive.entries_offset)
+        self.chapters = chapters
+        self.players = list(corpus_archive.players)
+        # the archive's chapters are stored one after another, but not
+        # necessarily in the order they're listed
+        chapter_codes = dict((chapter, n) for n, chapter in enumerate(chapters))
+        self.chapter_codes = numpy.repeat(
+            [chapter_codes[name] for name, first_entry, entry_count
+             in corpus_archive.chapters],
+            [entry_count for name, first_entry, entry_count
+             in corpus_archive.chapters])
+        self.type_codes = entries["type"].astype(numpy.int64)
+        self.player_codes = numpy.where(
+            entries["player"] == archive.NO_PLAYER, -1,
+            entries["player"].astype(numpy.int64))
+
+        strings = numpy.frombuffer(corpus_archive.data, dtype=numpy.uint8,
+                                   offset=corpus_archive.strings_offset)
+        self.text_lengths, self.word_counts = measure(
+            strings, entries["offset"].astype(numpy.int64),
+            entries["length"].astype(numpy.int64))
+
+    def load_entries(self, path):
+        """Read every entry, keeping only its codes and content."""
+        chapter_codes = []
+        type_codes = []
+        player_codes = []
+        player_codes_by_name = {}
+        contents = []
+
+        for chapter in self.exporter.list_chapters(path):
+            chapter_code = len(self.chapters)
+            self.chapters.append(chapter)
+            for entry in self.exporter.read_entries(os.path.join(path,
+                                                                 chapter)):
+                chapter_codes.append(chapter_code)
+                type_codes.append(entry.type_code)
+                player = entry.player
+                if player is None:
+                    player_codes.append(-1)
+                else:
+                    if player not in player_codes_by_name:
+                        player_codes_by_name[player] = len(self.players)
+                        self.players.append(player)
+                    player_codes.append(player_codes_by_name[player])
+                content = entry.content
+                if isinstance(content, unicode):
+                    content = content.encode("utf-8")
+                contents.append(content)
+
+        self.chapter_codes = numpy.array(chapter_codes, dtype=numpy.int64)
+        self.type_codes = numpy.array(type_codes, dtype=numpy.int64)
+        self.player_codes = numpy.array(player_codes, dtype=numpy.int64)
+        lengths = numpy.array([len(content) for content in contents],
+                              dtype=numpy.int64)
+        offsets = numpy.zeros(len(lengths), dtype=numpy.int64)
+        numpy.cumsum(lengths[:-1], out=offsets[1:])
+        self.text_lengths, self.word_counts = measure(
+            numpy.frombuffer("".join(contents), dtype=numpy.uint8),
+            offsets, lengths)
+
+    # statistics
+
+    def chapter_stats(self):
+        """One row per chapter, in order: entries of each type, words, and the
+        number of players who spoke."""
+        chapter_count = len(self.chapters)
+        type_counts = numpy.bincount(
+            self.chapter_codes * type_count + self.type_codes,
+            minlength=chapter_count * type_count).reshape(chapter_count,
+                                                          type_count)
+        words = numpy.bincount(self.chapter_codes, weights=self.word_counts,
+                               minlength=chapter_count)
+        characters = numpy.bincount(self.chapter_codes,
+                                    weights=self.text_lengths,
+                                    minlength=chapter_count)
+        speakers = (self.player_chapter_counts()[0] > 0).sum(axis=0)
+
+        statements = type_counts[:, STATEMENT]
+        emotes = type_counts[:, EMOTE]
+        rows = []
+        for n, chapter in enumerate(self.chapters):
+            rows.append({
+                "chapter": chapter,
+                "number": n + 1,
+                "entries": int(type_counts[n].sum()),
+                "text": int(type_counts[n, TEXT]),
+                "statements": int(statements[n]),
+                "emotes": int(emotes[n]),
+                "emotes_per_statement": round(
+                    float(emotes[n]) / statements[n], 3)
+                    if statements[n] else None,
+                "words": int(words[n]),
+                "characters": int(characters[n]),
+                "players": int(speakers[n]),
+            })
+        return rows
+
+    def player_chapter_counts(self):
+        """Return (statements, words, characters), each an array indexed by
+        player code and chapter code."""
+        shape = (len(self.players), len(self.chapters))
+        has_player = self.player_codes >= 0
+        keys = (self.player_codes[has_player] * len(self.chapters) +
+                self.chapter_codes[has_player])
+        size = shape[0] * shape[1]
+        return tuple(
+            numpy.bincount(keys, weights=weights, minlength=size).reshape(shape)
+            for weights in (None, self.word_counts[has_player],
+                            self.text_lengths[has_player]))
+
+    def player_chapter_stats(self):
+        """One row per player per chapter they spoke in, in chapter order."""
+        statements, words, characters = self.player_chapter_counts()
+        rows = []
+        for chapter_code, player_code in numpy.argwhere(statements.T > 0):
+            rows.append({
+                "chapter": self.chapters[chapter_code],
+                "player": self.players[player_code],
+                "statements": int(statements[player_code, chapter_code]),
+                "words": int(words[player_code, chapter_code]),
+                "characters": int(characters[player_code, chapter_code]),
+            })
+        return rows
+
+    def player_stats(self):
+        """One row per player, most talkative first."""
+        statements, words, characters = self.player_chapter_counts()
+        chapters = (statements > 0).sum(axis=1)
+        first = numpy.where(statements > 0, numpy.arange(len(self.chapters)),
+                            len(self.chapters)).min(axis=1)
+        total_words = words.sum(axis=1)
+        rows = []
+        for player_code in numpy.argsort(-total_words, kind="mergesort"):
+            total_statements = statements[player_code].sum()
+            rows.append({
+                "player": self.players[player_code],
+                "chapters": int(chapters[player_code]),
+                "first_chapter": self.chapters[first[player_code]]
+                                 if chapters[player_code] else None,
+                "statements": int(total_statements),
+                "words": int(total_words[player_code]),
+                "characters": int(characters[player_code].sum()),
+                "words_per_statement": round(
+                    float(total_words[player_code]) / total_statements, 2)
+                    if total_statements else None,
+            })
+        return rows
+
+    def totals(self):
+        counts = numpy.bincount(self.type_codes, minlength=type_count)
+        totals = {
+            "chapters": len(self.chapters),
+            "players": len(self.players),
+            "entries": int(len(self.type_codes)),
+            "words": int(self.word_counts.sum()),
+            "characters": int(self.text_lengths.sum()),
+        }
+        for type_code, name in enumerate(entry_types):
+            totals[name] = int(counts[type_code])
+        return totals
+
+    # output
+
+    def stats(self):
+        """Every statistic, as a dict of lists of rows."""
+        return {
+            "totals": self.totals(),
+            "chapters": self.chapter_stats(),
+            "players": self.player_stats(),
+            "player_chapters": self.player_chapter_stats(),
+        }
+
+    def write_files(self, output_dir):
+        """Write chapters.csv, players.csv, player_chapters.csv and
+        stats.json to output_dir."""
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        stats = self.stats()
+        columns = {
+            "chapters": ["number", "chapter", "entries", "text", "statements",
+                         "emotes", "emotes_per_statement", "words",
+                         "characters", "players"],
+            "players": ["player", "chapters", "first_chapter", "statements",
+                        "words", "characters", "words_per_statement"],
+            "player_chapters": ["chapter", "player", "statements", "words",
+                                "characters"],
+        }
+        for name in sorted(columns):
+            output_file = file(os.path.join(output_dir, name + ".csv"), "wb")
+            writer = csv.writer(output_file)
+            writer.writerow(columns[name])
+            for row in stats[name]:
+                writer.writerow([
+                    row[column].encode("utf-8")
+                    if isinstance(row[column], unicode) else row[column]
+                    for column in columns[name]])
+            output_file.close()
+
+        output_file = file(os.path.join(output_dir, "stats.json"), "w")
+        json.dump(stats, output_file, indent=1, sort_keys=True)
+        output_file.close()
+
+    def write_page(self, output_filename, template_filename, index=None):
+        """Write the chapter and player tables as an HTML page, linking back to
+        index if given."""
+        def table(rows, columns):
+            lines = [u"<tr>%s</tr>" % u"".join(
+                u"<th>%s</th>" % column.replace("_", " ")
+                for column in columns)]
+            for row in rows:
+                lines.append(u"<tr>%s</tr>" % u"".join(
+                    u"<td>%s</td>" % escape(u"" if row[column] is None
+                                            else unicode(row[column]))
+                    for column in columns))
+            return u"\n".join(lines)
+
+        totals = self.totals()
+        output_file = codecs.open(output_filename, encoding="utf-8", mode="w")
+        template.render_to(output_file, template_filename, {
+            "index": index,
+            "totals": u"%d chapters, %d players, %d entries, %d words" % (
+                totals["chapters"], totals["players"], totals["entries"],
+                totals["words"]),
+            "players": table(self.player_stats(),
+                             ["player", "chapters", "statements", "words",
+                              "words_per_statement"]),
+            "chapters": table(self.chapter_stats(),
+                              ["number", "chapter", "entries", "statements",
+                               "emotes", "emotes_per_statement", "words",
+                               "players"]),
+        })
+        output_file.close()
@@ -0,0 +1,175 @@
+# A compact binary form of the whole imported corpus, which can be opened
+# without parsing anything but a few small tables.
+#
+# Layout (all integers little-endian):
+#
+#   header    magic, format version, and the counts and offsets of each table
+#   players   (offset, length) of each distinct player name in the strings
+#   chapters  (name offset, name length, first entry, entry count)
+#   entries   (type code, player code, content offset, content length)
+#   strings   every name and every entry's content, UTF-8, end to end
+#
+# String offsets are relative to the start of the strings region.
+import os
+import mmap
+import struct
+import shutil
+import tempfile
+from log_entry import LogEntry, intern_player
+
+MAGIC = "DHLA"
+VERSION = 1
+
+header_format = struct.Struct("<4sHHIIIQQQQ")
+player_format = struct.Struct("<II")
+chapter_format = struct.Struct("<IIII")
+entry_format = struct.Struct("<BHII")
+
+NO_PLAYER = 0xFFFF
+
+
+def is_archive(path):
+    """True if path is an archive file."""
+    if not os.path.isfile(path):
+        return False
+    input_file = file(path, "rb")
+    magic = input_file.read(len(MAGIC))
+    input_file.close()
+    return magic == MAGIC
+
+
+class ArchiveWriter(object):
+    """Builds an archive one chapter at a time. Entry records and strings are
+    spooled to temporary files, so memory use doesn't grow with the corpus."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.strings = tempfile.TemporaryFile()
+        self.strings_length = 0
+        self.entries = tempfile.TemporaryFile()
+        self.entry_count = 0
+        self.player_codes = {}
+        self.players = []  # (offset, length) for each player code
+        self.chapters = []
+
+    def add_string(self, text):
+        """Append text to the strings region; return its (offset, length)."""
+        if isinstance(text, unicode):
+            text = text.encode("utf-8")
+        offset = self.strings_length
+        self.strings.write(text)
+        self.strings_length += len(text)
+        return (offset, len(text))
+
+    def player_code(self, player):
+        if player is None:
+            return NO_PLAYER
+        if player not in self.player_codes:
+            if len(self.players) == NO_PLAYER:
+                raise Exception("Too many players for archive format")
+            self.player_codes[player] = len(self.players)
+            self.players.append(self.add_string(player))
+        return self.player_codes[player]
+
+    def add_chapter(self, name, log_entries):
+        """Add a chapter from an iterable of LogEntries."""
+        first_entry = self.entry_count
+        for entry in log_entries:
+            offset, length = self.add_string(entry.content)
+            self.entries.write(entry_format.pack(
+                entry.type_code, self.player_code(entry.player),
+                offset, length))
+            self.entry_count += 1
+        name_offset, name_length = self.add_string(name)
+        self.chapters.append((name_offset, name_length, first_entry,
+                              self.entry_count - first_entry))
+
+    def close(self):
+        """Write the finished archive, by way of a temporary file so that a
+        reader never sees half an archive."""
+        players_offset = header_format.size
+        chapters_offset = players_offset + player_format.size * len(self.players)
+        entries_offset = chapters_offset + (chapter_format.size *
+                                            len(self.chapters))
+        strings_offset = entries_offset + entry_format.size * self.entry_count
+
+        temp_filename = self.filename + ".tmp"
+        output_file = file(temp_filename, "wb")
+        output_file.write(header_format.pack(
+            MAGIC, VERSION, 0, len(self.chapters), len(self.players),
+            self.entry_count, players_offset, chapters_offset, entries_offset,
+            strings_offset))
+        for player in self.players:
+            output_file.write(player_format.pack(*player))
+        for chapter in self.chapters:
+            output_file.write(chapter_format.pack(*chapter))
+        for spool in (self.entries, self.strings):
+            spool.seek(0)
+            shutil.copyfileobj(spool, output_file)
+            spool.close()
+        output_file.close()
+        os.rename(temp_filename, self.filename)
+
+
+class Archive(object):
+    """Reads an archive through mmap. Opening it decodes only the player and
+    chapter tables; entries are decoded one at a time as they're asked for."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = file(filename, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, reserved, chapter_count, player_count,
+         self.entry_count, players_offset, chapters_offset,
+         self.entries_offset, self.strings_offset) = header_format.unpack_from(
+             self.data, 0)
+        if magic != MAGIC:
+            raise Exception("%s is not a log archive" % filename)
+        if version != VERSION:
+            raise Exception("%s is archive version %d; expected %d"
+                            % (filename, version, VERSION))
+
+        self.players = [
+            intern_player(self.string(*player_format.unpack_from(
+                self.data, players_offset + player_format.size * n)))
+            for n in range(player_count)]
+
+        self.chapters = []
+        self.chapter_indexes = {}
+        for n in range(chapter_count):
+            name_offset, name_length, first_entry, entry_count = (
+                chapter_format.unpack_from(
+                    self.data, chapters_offset + chapter_format.size * n))
+            name = self.string(name_offset, name_length)
+            self.chapter_indexes[name] = n
+            self.chapters.append((name, first_entry, entry_count))
+
+    def string(self, offset, length):
+        start = self.strings_offset + offset
+        return self.data[start:start + length].decode("utf-8")
+
+    def chapter_names(self):
+        return [name for name, first_entry, entry_count in self.chapters]
+
+    def entry_count(self, name):
+        return self.chapters[self.chapter_indexes[name]][2]
+
+    def entries(self, name):
+        """Generate the entries of the named chapter as LogEntries, just as
+        they would be read from its JSON."""
+        chapter_name, first_entry, entry_count = self.chapters[
+            self.chapter_indexes[name]]
+        offset = self.entries_offset + entry_format.size * first_entry
+        for n in xrange(entry_count):
+            type_code, player_code, content_offset, content_length = (
+                entry_format.unpack_from(self.data, offset))
+            offset += entry_format.size
+            yield LogEntry(type_code,
+                           self.string(content_offset, content_length),
+                           self.players[player_code]
+                           if player_code != NO_PLAYER else None)
+
+    def close(self):
+        self.data.close()
+        self.file.close()
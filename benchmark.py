@@ -0,0 +1,299 @@
+# Command-line program which times the importer and exporters against a
+# synthetic corpus, so that a change can be checked for speedups and
+# regressions. Results are saved as JSON and can be compared with an earlier
+# run.
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import resource
+import tempfile
+import multiprocessing
+from clint import args
+import log_conversion
+
+usage = """
+Generates a synthetic corpus of logs in every format the importer understands,
+then times importing it and exporting it as text, HTML, and markdown (the
+intermediate step of an epub), reporting lines per second and peak memory.
+
+Flags:
+
+-n lines [optional] Lines of log to generate. Defaults to 100000.
+
+-s seed [optional] Random seed for the corpus. Defaults to 1, so that runs with
+the same -n are comparable.
+
+-j N [optional] Import and export on N worker processes. Defaults to 1.
+
+-o path [optional] Save the results as JSON at path.
+
+-c path [optional] Compare the results with an earlier run saved by -o.
+
+-d work_dir [optional] Generate the corpus and outputs here, and keep them.
+Otherwise a temporary directory is used and removed afterwards.
+
+Usage: python benchmark.py [-n lines] [-j N] [-o results.json]
+                           [-c previous.json] [-d work_dir]
+"""
+
+players = ["Alan", "Dorothea", "Matt", "Adrian", "Sir Reginald", "Grok"]
+words = ("the dragon hunt sword tavern ale roll cave quietly loud gold "
+         "north wizard spell arrow goblin door <i>fire</i> <b>loud</b> "
+         "&amp; 3d6 1d20 &quot;hmm&quot;").split()
+words.append("<font color='#008000'>heal</font>")
+
+# the six OpenRPG line formats, matching LogImporter.content_patterns in order
+openRPG_line_templates = (
+    "<B>(%(id)d) %(player)s</B>: <font color='#800040'>%(text)s</font><br>",
+    "<B>%(player)s</B>: <font color='#800040'>%(text)s</font><br>",
+    "<p><b>%(player)s</b>: %(text)s</p>",
+    "<font color='#123456'>** (%(id)d) %(player)s %(text)s **</font><br>",
+    "<font color='#123456'>** %(player)s %(text)s **</font><br>",
+    "<p>** %(player)s %(text)s **</p>",
+)
+campfire_row_template = (
+    '<tr class="text_message message user_%(id)d" id="message_%(n)d">'
+    '<td class="person"><span class="author">%(player)s</span></td>'
+    '<td class="body"><div class="body">%(text)s</div></td></tr>\n')
+
+lines_per_file = 2000
+
+
+class CorpusGenerator(object):
+    """Writes a directory of random logs: mostly OpenRPG logs in all three
+    versions (some with timestamps), plus Campfire transcripts and text
+    logs."""
+
+    def __init__(self, seed=1):
+        self.random = random.Random(seed)
+        # share of the corpus in each kind of file
+        self.kinds = (("openRPG", 0.8), ("campfire", 0.1), ("text", 0.1))
+        self.timestamp_chance = 0.5
+
+    def sentence(self):
+        return " ".join(self.random.choice(words)
+                        for n in range(self.random.randint(3, 15)))
+
+    def timestamp(self):
+        return "[Mon Jan %d 21:%02d:%02d 2009] : " % (
+            self.random.randint(10, 28), self.random.randint(0, 59),
+            self.random.randint(0, 59))
+
+    def openRPG_line(self):
+        line = self.random.choice(openRPG_line_templates) % {
+            "id": self.random.randint(1, 999),
+            "player": self.random.choice(players),
+            "text": self.sentence(),
+        }
+        if self.random.random() < self.timestamp_chance:
+            line = self.timestamp() + line
+        return line
+
+    def write_openRPG_log(self, filename, line_count):
+        output_file = file(filename, "w")
+        for n in xrange(line_count):
+            output_file.write(self.openRPG_line() + "\r\n")
+        output_file.close()
+
+    def write_campfire_log(self, filename, line_count):
+        output_file = file(filename, "w")
+        output_file.write("<html>\n<head>\n  <title>Campfire: Dragonhunt"
+                          "</title>\n</head>\n<body>\n<table>\n")
+        for n in xrange(line_count):
+            output_file.write(campfire_row_template % {
+                "id": self.random.randint(1, 9),
+                "n": n,
+                "player": self.random.choice(players),
+                "text": self.sentence(),
+            })
+            if self.random.random() < 0.05:  # not every row is a message
+                output_file.write('<tr class="enter_message"><td>Someone has '
+                                  'entered the room</td></tr>\n')
+        output_file.write("</table>\n</body>\n</html>\n")
+        output_file.close()
+
+    def write_text_log(self, filename, line_count):
+        output_file = file(filename, "w")
+        for n in xrange(line_count):
+            output_file.write(self.sentence() + "\n\n")
+        output_file.close()
+
+    def generate(self, output_dir, line_count):
+        """Write line_count lines of logs to output_dir, in files of at most
+        lines_per_file lines. Returns the number of files written."""
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        writers = {
+            "openRPG": (self.write_openRPG_log, ".html"),
+            "campfire": (self.write_campfire_log, ".html"),
+            "text": (self.write_text_log, ".txt"),
+        }
+        file_count = 0
+        for kind, share in self.kinds:
+            remaining = max(1, int(line_count * share))
+            n = 0
+            while remaining > 0:
+                count = min(remaining, lines_per_file)
+                write, extension = writers[kind]
+                write(os.path.join(output_dir,
+                                   "%s_%03d%s" % (kind, n, extension)), count)
+                remaining -= count
+                n += 1
+                file_count += 1
+        return file_count
+
+
+def peak_memory_kb():
+    """Peak resident memory of this process, or of the largest of its worker
+    processes, so far, in kilobytes."""
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if sys.platform == "darwin":  # bytes there, kilobytes elsewhere
+        peak /= 1024
+    return peak
+
+
+def _run_stage(function, arguments, results):
+    """Run in a fresh process, so that each stage's peak memory is its own.
+    The stage's own progress messages are thrown away."""
+    sys.stdout = file(os.devnull, "w")
+    try:
+        start = time.time()
+        value = function(*arguments)
+        seconds = time.time() - start
+        results.put((seconds, peak_memory_kb(), value, None))
+    except Exception as e:
+        results.put((0, 0, None, "%s: %s" % (e.__class__.__name__, e)))
+
+
+def time_stage(function, *arguments):
+    """Call function(*arguments) in a child process; return (seconds, peak
+    memory in KB, return value)."""
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_stage,
+                                      args=(function, arguments, results))
+    process.start()
+    seconds, peak, value, error = results.get()
+    process.join()
+    if error is not None:
+        raise Exception(error)
+    return (seconds, peak, value)
+
+
+# stages; module-level so that they can be run in child processes
+
+def import_stage(input_dir, output_dir, jobs):
+    results = log_conversion.LogImporter().process_directory(
+        input_dir, output_dir, jobs=jobs, force=True)
+    return (sum(count for input_file, count, error in results),
+            len([error for input_file, count, error in results if error]))
+
+
+def text_stage(input_dir, output_dir, jobs):
+    log_conversion.LogExporter().output_directory(input_dir, output_dir, jobs)
+
+
+def html_stage(input_dir, output_dir, jobs):
+    log_conversion.HTMLExporter().output_directory(input_dir, output_dir,
+                                                   jobs=jobs)
+
+
+def markdown_stage(input_dir, output_dir, jobs):
+    log_conversion.EpubExporter().output_directory(input_dir, output_dir, jobs)
+
+
+def run(work_dir, line_count, seed=1, jobs=1):
+    """Generate a corpus in work_dir and time every stage on it. Returns the
+    results as a dict."""
+    input_dir = os.path.join(work_dir, "logs")
+    json_dir = os.path.join(work_dir, "json")
+
+    print "Generating %d lines of logs in %s" % (line_count, input_dir)
+    if os.path.exists(input_dir):
+        shutil.rmtree(input_dir)
+    file_count = CorpusGenerator(seed).generate(input_dir, line_count)
+
+    results = {
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "lines": line_count,
+        "files": file_count,
+        "seed": seed,
+        "jobs": jobs,
+        "stages": {},
+    }
+
+    stages = (
+        ("import", import_stage, input_dir, json_dir),
+        ("text", text_stage, json_dir, os.path.join(work_dir, "text")),
+        ("html", html_stage, json_dir, os.path.join(work_dir, "html")),
+        ("markdown", markdown_stage, json_dir,
+         os.path.join(work_dir, "markdown")),
+    )
+    for name, function, stage_input, stage_output in stages:
+        seconds, peak, value = time_stage(function, stage_input, stage_output,
+                                          jobs)
+        if name == "import":
+            results["entries"], results["import_failures"] = value
+            if results["import_failures"]:
+                print "Warning: %d files failed to import" % (
+                    results["import_failures"])
+        # the exporters see entries, not lines; rate them by the lines they
+        # came from, so that every stage is measured on the same scale
+        results["stages"][name] = {
+            "seconds": round(seconds, 3),
+            "lines_per_second": round(line_count / max(seconds, 1e-6), 1),
+            "peak_memory_kb": peak,
+        }
+        print "%-10s %8.2fs %12.0f lines/s %10d KB peak" % (
+            name, seconds, line_count / max(seconds, 1e-6), peak)
+    return results
+
+
+def compare(results, previous):
+    """Print how each stage's speed and memory changed since previous."""
+    print
+    print "Compared with the run of %s (%d lines):" % (previous["date"],
+                                                      previous["lines"])
+    for name in sorted(results["stages"]):
+        if name not in previous["stages"]:
+            continue
+        now = results["stages"][name]
+        before = previous["stages"][name]
+        print "%-10s speed x%.2f, peak memory x%.2f" % (
+            name, now["lines_per_second"] / max(before["lines_per_second"], 1e-6),
+            float(now["peak_memory_kb"]) / max(before["peak_memory_kb"], 1))
+
+
+if __name__ == "__main__":
+    if args.get(0) is "--help":
+        print usage
+        sys.exit()
+
+    groups = dict(args.grouped)
+    line_count = int(groups["-n"][0]) if groups.has_key("-n") else 100000
+    seed = int(groups["-s"][0]) if groups.has_key("-s") else 1
+    jobs = int(groups["-j"][0]) if groups.has_key("-j") else 1
+
+    if groups.has_key("-d"):
+        work_dir = groups["-d"][0]
+    else:
+        work_dir = tempfile.mkdtemp(prefix="dh-logs-benchmark-")
+    try:
+        results = run(work_dir, line_count, seed, jobs)
+    finally:
+        if not groups.has_key("-d"):
+            shutil.rmtree(work_dir)
+
+    if groups.has_key("-o"):
+        output_file = file(groups["-o"][0], "w")
+        json.dump(results, output_file, indent=2, sort_keys=True)
+        output_file.close()
+        print "Saved results to %s" % groups["-o"][0]
+    if groups.has_key("-c"):
+        compare(results, json.load(file(groups["-c"][0])))
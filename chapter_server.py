@@ -0,0 +1,159 @@
+# Serves the HTML export straight from the imported JSON, rendering each
+# chapter when it's first asked for instead of prerendering every one. Pages
+# are rendered just as HTMLExporter would write them, and kept in an LRU cache
+# until their JSON changes, or their previous/next links do; the chapter list
+# is read afresh for each request, so newly imported chapters show up at once.
+#
+# Every response has an ETag and a Last-Modified date, so that a browser which
+# already has the page is told so with a 304 instead of being sent it again.
+import os
+import re
+import urllib
+import hashlib
+import BaseHTTPServer
+from email.utils import formatdate, parsedate_tz, mktime_tz
+import template
+from lru import LRUCache
+from log_conversion import HTMLExporter
+
+
+class ChapterServer(BaseHTTPServer.HTTPServer):
+    """Serves json_dir, a directory of JSON files or an archive, as HTML. One
+    request is handled at a time."""
+
+    def __init__(self, json_dir, address=("127.0.0.1", 8000),
+                 cache_size=32 * 1024 * 1024):
+        BaseHTTPServer.HTTPServer.__init__(self, address,
+                                           ChapterRequestHandler)
+        self.json_dir = json_dir
+        self.exporter = HTMLExporter()
+        self.archive_mtime = None
+        # (validator, page) by page name, bounded by the pages' total size in
+        # bytes; see chapter_page
+        self.cache = LRUCache(cache_size,
+                              size_of=lambda cached: len(cached[1]["body"]))
+
+    def page(self, name):
+        """Return the named page, e.g. "index.html" or "session_01.html", as a
+        dict of body (UTF-8), etag, and modified (a timestamp); or None if
+        there's no such chapter."""
+        self.check_archive()
+        chapters = self.exporter.list_chapters(self.json_dir)
+        names = [re.sub(self.exporter.input_extension_pattern,
+                        self.exporter.output_file_extension, chapter)
+                 for chapter in chapters]
+
+        if name == self.exporter.index_basename:
+            # adding or removing a chapter changes the directory's mtime
+            return self.render(self.exporter.index_template,
+                               self.exporter.index_replacements(names),
+                               os.stat(self.json_dir).st_mtime)
+        if name not in names:
+            return None
+        # linked just as HTMLExporter links the pages it writes
+        for chapter, output_dict in zip(chapters,
+                                        self.exporter.links(names)):
+            if output_dict["current"] == name:
+                return self.chapter_page(
+                    os.path.join(self.json_dir, chapter), name,
+                    output_dict["previous"], output_dict["next"])
+
+    def chapter_page(self, input_filename, name, previous_name, next_name):
+        """Return the chapter's page from the cache, or render it if its
+        source, links or template have changed since it was cached."""
+        if self.archive_mtime is not None:
+            source = os.stat(self.json_dir)
+        else:
+            source = os.stat(input_filename)
+        validator = (source.st_mtime, source.st_size, previous_name, next_name,
+                     os.stat(self.exporter.log_template).st_mtime)
+        cached = self.cache.get(name)
+        if cached is not None and cached[0] == validator:
+            return cached[1]
+
+        page = self.render(self.exporter.log_template,
+                           self.exporter.page_replacements(
+                               input_filename, previous_name, next_name),
+                           source.st_mtime)
+        self.cache.put(name, (validator, page))
+        return page
+
+    def render(self, template_filename, replacements, modified):
+        body = u"".join(template.render(template_filename,
+                                        replacements)).encode("utf-8")
+        return {
+            "body": body,
+            "etag": '"%s"' % hashlib.sha1(body).hexdigest()[:20],
+            "modified": max(modified, os.stat(template_filename).st_mtime),
+        }
+
+    def check_archive(self):
+        """If json_dir is an archive which has been rewritten since it was
+        opened, close it, so that it's opened again."""
+        if not self.exporter.is_archive(self.json_dir):
+            return
+        mtime = os.stat(self.json_dir).st_mtime
+        if self.archive_mtime is not None and mtime != self.archive_mtime:
+            old_archive = self.exporter.archives.pop(self.json_dir, None)
+            if old_archive is not None:
+                old_archive.close()
+        self.archive_mtime = mtime
+
+
+class ChapterRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_page(include_body=True)
+
+    def do_HEAD(self):
+        self.send_page(include_body=False)
+
+    def send_page(self, include_body):
+        name = urllib.unquote(self.path.split("?")[0]).lstrip("/")
+        if name == "":
+            name = self.server.exporter.index_basename
+        if "/" in name or name.startswith("."):
+            self.send_error(404)
+            return
+        try:
+            page = self.server.page(name)
+        except Exception as e:
+            self.send_error(500, "%s: %s" % (e.__class__.__name__, e))
+            return
+        if page is None:
+            self.send_error(404)
+            return
+
+        if self.is_not_modified(page):
+            self.send_response(304)
+            self.send_validators(page)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(page["body"])))
+        self.send_validators(page)
+        self.end_headers()
+        if include_body:
+            self.wfile.write(page["body"])
+
+    def send_validators(self, page):
+        self.send_header("ETag", page["etag"])
+        self.send_header("Last-Modified", formatdate(page["modified"],
+                                                     usegmt=True))
+        # may be kept, but must be checked with us before it's reused
+        self.send_header("Cache-Control", "no-cache")
+
+    def is_not_modified(self, page):
+        """True if the request's conditional headers match page. If-None-Match
+        wins over If-Modified-Since, as HTTP says it should."""
+        etags = self.headers.get("If-None-Match")
+        if etags is not None:
+            etags = [re.sub(r"^W/", "", etag.strip())
+                     for etag in etags.split(",")]
+            return "*" in etags or page["etag"] in etags
+        since = self.headers.get("If-Modified-Since")
+        if since is not None:
+            since = parsedate_tz(since)
+            if since is not None:
+                return int(page["modified"]) <= mktime_tz(since)
+        return False
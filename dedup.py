@@ -0,0 +1,64 @@
+# Command-line program which finds chapters that overlap, because more than one
+# person logged the same session, and writes the JSON without the repeats.
+import sys
+import time
+from overlaps import OverlapFinder
+from clint import args
+
+usage = """
+Compares the chapters in json_dir, a directory of JSON files or an archive
+written by import.py --archive, and prints where each repeats an earlier one.
+A chapter which another, longer chapter almost entirely repeats is dropped;
+otherwise whatever a chapter repeats of an earlier chapter is trimmed from it.
+
+Flags:
+
+-o output_dir [optional] Write the chapters, without what's dropped and
+trimmed, to output_dir; export from there instead of json_dir. Without -o,
+nothing is written but the report.
+
+--report path [optional] Save the full report, with every overlapping span, as
+JSON.
+
+--min-span N [optional] Ignore runs of fewer than N repeated entries. Defaults
+to 10.
+
+Usage: python dedup.py json_dir [-o output_dir] [--report report.json]
+                                [--min-span N]
+"""
+
+groups = dict(args.grouped)
+positional = groups["_"].all if groups.has_key("_") else []
+
+if args.get(0) is "--help" or len(positional) != 1:
+    print usage
+    sys.exit()
+
+json_dir = positional[0]
+finder = OverlapFinder()
+if groups.has_key("--min-span"):
+    finder.min_span = int(groups["--min-span"][0])
+
+start = time.time()
+finder.find(json_dir)
+actions = finder.plan()
+report = finder.report(actions)
+for chapter in report["chapters"]:
+    if chapter["action"] == "drop":
+        print "%s: drop; repeated by %s" % (chapter["chapter"],
+                                            chapter["contained_in"])
+    elif chapter["action"] == "trim":
+        print "%s: trim %d of %d entries, repeated from %s" % (
+            chapter["chapter"], chapter["trimmed"], chapter["entries"],
+            ", ".join(sorted(set(overlap["other_chapter"] for overlap
+                                 in chapter["overlaps"]))))
+print "%d chapters; %d to drop, %d entries to trim (%.2fs)" % (
+    len(report["chapters"]), report["dropped"], report["trimmed_entries"],
+    time.time() - start)
+
+if groups.has_key("--report"):
+    finder.save_report(actions, groups["--report"][0])
+    print "Saved report to %s" % groups["--report"][0]
+if groups.has_key("-o"):
+    finder.write(json_dir, groups["-o"][0], actions)
+    print "Wrote chapters to %s" % groups["-o"][0]
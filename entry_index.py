@@ -0,0 +1,180 @@
+# A sidecar index for each chapter's JSON, written by LogImporter alongside
+# it, so that some of a chapter's entries can be read without decoding the
+# rest: where each entry's JSON starts and how long it is, plus its type and
+# player, for picking entries out.
+#
+# Layout (all integers little-endian):
+#
+#   header    magic, format version, entry count, player count, and the size,
+#             mtime and SHA-1 (hex) of the JSON file indexed, to tell when the
+#             index is out of date
+#   players   length of each distinct player name, then the names, UTF-8
+#   offsets   byte offset of each entry in the JSON file (8 bytes each)
+#   lengths   length of each entry's JSON (4 bytes each)
+#   types     type code of each entry (1 byte each; see log_entry.entry_types)
+#   players   player code of each entry (2 bytes each; archive.NO_PLAYER if
+#             none)
+import os
+import json
+import shutil
+import struct
+import tempfile
+import archive
+from manifest import file_hash
+from log_entry import from_dict
+
+MAGIC = "DHLI"
+VERSION = 2
+
+header_format = struct.Struct("<4sHHIIQd40s")
+
+
+def index_filename(json_filename):
+    """The index for a chapter's JSON: chapter.json.idx, chapter.jsonl.idx."""
+    return json_filename + ".idx"
+
+
+def pack_values(code, values):
+    """Pack a list of integers of the given struct code, little-endian."""
+    return struct.pack("<%d%s" % (len(values), code), *values)
+
+
+def read_values(input_file, code, count):
+    """Read count integers of the given struct code, as a tuple."""
+    value_format = struct.Struct("<%d%s" % (count, code))
+    return value_format.unpack(input_file.read(value_format.size))
+
+
+class EntryIndexWriter(object):
+    """Builds the index for a JSON file as its entries are written. Each table
+    is kept a batch at a time, then packed into a temporary file of its own,
+    so memory doesn't grow with the log."""
+
+    def __init__(self, filename, batch_size=4096):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.entry_count = 0
+        self.offsets = []
+        self.lengths = []
+        self.types = []
+        self.player_ids = []
+        # (struct code, batch, temporary file) for each table, in file order
+        self.tables = [(code, values, tempfile.TemporaryFile())
+                       for code, values in (("Q", self.offsets),
+                                            ("I", self.lengths),
+                                            ("B", self.types),
+                                            ("H", self.player_ids))]
+        self.player_codes = {}
+        self.players = []
+
+    def add(self, offset, length, entry):
+        """Record an entry whose JSON is length bytes at offset."""
+        self.offsets.append(offset)
+        self.lengths.append(length)
+        self.types.append(entry.type_code)
+        player = entry.player
+        if player is None:
+            self.player_ids.append(archive.NO_PLAYER)
+        else:
+            if player not in self.player_codes:
+                if len(self.players) == archive.NO_PLAYER:
+                    raise Exception("Too many players for index format")
+                self.player_codes[player] = len(self.players)
+                self.players.append(player)
+            self.player_ids.append(self.player_codes[player])
+        self.entry_count += 1
+        if len(self.offsets) == self.batch_size:
+            self.flush()
+
+    def flush(self):
+        for code, values, table_file in self.tables:
+            table_file.write(pack_values(code, values))
+            del values[:]
+
+    def close(self, json_filename, json_hash):
+        """Write the index of json_filename, whose contents have the SHA-1 hex
+        digest json_hash. It goes by way of a temporary file, so a reader never
+        sees half an index."""
+        self.flush()
+        names = [player.encode("utf-8") if isinstance(player, unicode)
+                 else player for player in self.players]
+        stat = os.stat(json_filename)
+        temp_filename = self.filename + ".tmp"
+        output_file = file(temp_filename, "wb")
+        output_file.write(header_format.pack(
+            MAGIC, VERSION, 0, self.entry_count, len(names), stat.st_size,
+            stat.st_mtime, json_hash))
+        output_file.write(pack_values("H", [len(name) for name in names]))
+        output_file.write("".join(names))
+        for code, values, table_file in self.tables:
+            table_file.seek(0)
+            shutil.copyfileobj(table_file, output_file)
+            table_file.close()
+        output_file.close()
+        os.rename(temp_filename, self.filename)
+
+
+class EntryIndex(object):
+    """Reads an index, and through it, selected entries of its JSON file. An
+    index written by another version of this module is never current."""
+
+    def __init__(self, filename):
+        input_file = file(filename, "rb")
+        header = input_file.read(header_format.size)
+        if header[:4] != MAGIC:
+            raise Exception("%s is not an entry index" % filename)
+        self.version = struct.unpack_from("<H", header, 4)[0]
+        if self.version != VERSION:
+            input_file.close()
+            self.players = []
+            self.offsets = self.lengths = self.types = self.player_ids = ()
+            return
+        (magic, version, reserved, entry_count, player_count, self.json_size,
+         self.json_mtime, self.json_hash) = header_format.unpack(header)
+
+        name_lengths = read_values(input_file, "H", player_count)
+        self.players = [input_file.read(length).decode("utf-8")
+                        for length in name_lengths]
+        self.offsets = read_values(input_file, "Q", entry_count)
+        self.lengths = read_values(input_file, "I", entry_count)
+        self.types = read_values(input_file, "B", entry_count)
+        self.player_ids = read_values(input_file, "H", entry_count)
+        input_file.close()
+
+    def is_current(self, json_filename):
+        """True if json_filename hasn't changed since it was indexed. As with
+        Manifest, it's only hashed if its size is the same but its mtime
+        isn't."""
+        if self.version != VERSION:
+            return False
+        stat = os.stat(json_filename)
+        if stat.st_size != self.json_size:
+            return False
+        return (stat.st_mtime == self.json_mtime or
+                file_hash(json_filename) == self.json_hash)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def positions(self, first=0, last=None, players=None):
+        """Return the positions of the entries from first to last (inclusive,
+        from 0), optionally only those by players (lowercase names)."""
+        if last is None or last >= len(self.offsets):
+            last = len(self.offsets) - 1
+        positions = xrange(first, last + 1)
+        if players is None:
+            return list(positions)
+        player_ids = set(code for code, name in enumerate(self.players)
+                         if name.lower() in players)
+        entry_player_ids = self.player_ids
+        return [position for position in positions
+                if entry_player_ids[position] in player_ids]
+
+    def entries(self, json_filename, positions):
+        """Generate the entries at positions, reading only their JSON."""
+        input_file = file(json_filename, "rb")
+        for position in positions:
+            input_file.seek(self.offsets[position])
+            entry = json.loads(input_file.read(self.lengths[position]))
+            yield from_dict(entry)
+        input_file.close()
@@ -1,4 +1,5 @@
 # Command-line program which exports JSON files to text, HTML, epub, or mobi.
+import os
 import sys
 import log_conversion
 from clint import args
@@ -9,19 +10,60 @@ output directory.
 
 Flags (may occur in any order):
 
--f format [optional] Format to generate: may be "text", "html", "epub", or
-"mobi". Defaults to "text".
+-f format [optional] Format to generate: may be "text", "html", "site", "epub",
+or "mobi", or several separated by commas. Defaults to "text". "site" is HTML
+for publishing: long chapters are split into pages, the CSS is in one shared
+stylesheet, and every file gets a gzipped copy (and a brotli one, if the brotli
+module is installed) which a static server can send as it is.
 
--i path Directory from which to read input files
+With several formats, each chapter is read once for all of them. output_path is
+then a directory: each format goes in a folder of it named after the format,
+except an ebook, which is named after output_path, e.g. release/release.epub.
+
+-i path Directory from which to read input files, or an archive written by
+import.py --archive
 
 -o path Directory to which to write output files; or the path to the output
 file, if an ebook is to be created
 
+-u [optional] Update an existing HTML export: only chapters whose JSON, or
+previous/next links, have changed since the last -u export are rendered again,
+and the index only if the list of chapters has changed.
+
+--stats [optional] With -f html, also write stats.html, a page of statistics
+on the chapters and players, and link to it from the index. Needs NumPy; see
+stats.py for the same statistics as CSV and JSON.
+
+-p N [optional] With -f site, entries per page. Defaults to 500.
+
+-c chapters [optional] Export only these chapters: a comma-separated list of
+chapter names, numbers, and ranges of numbers, counting from 1 in name order;
+e.g. "40-55", or "12,session_20".
+
+-r first-last [optional] Export only this range of entries from each chapter,
+counting from 1; e.g. "1-100", or "500-" for the 500th onwards.
+
+--players names [optional] Export only what these players said; a
+comma-separated list, not case-sensitive.
+
+With -r or --players, only the selected entries are read, if the chapter has
+the entry index which import.py writes beside each JSON file.
+
+-j N [optional] Write chapters on N worker processes. Defaults to 1.
+
+--pandoc [optional] Build the epub (or the epub step of a mobi) with Pandoc,
+as before, instead of the built-in builder. The built-in builder keeps each
+chapter's XHTML in a .cache folder beside the book, and only regenerates the
+chapters whose JSON has changed.
+
 Usage:
 Generate text: python -i json_dir -o text_dir
 Generate html: python -f html -i json_dir -o html_dir
+Generate site: python -f site -i json_dir -o site_dir
 Generate epub: python -f epub -i json_dir -o epub_dir/my_book.epub
 Generate mobi: python -f mobi -i json_dir -o mobi_dir/my_book.mobi
+Generate a release: python -f text,html,epub -i json_dir -o release
+Alan's lines in chapter 12: python -i json_dir -o recap_dir -c 12 --players Alan
 
 Note that the mobi version will create an epub file as an intermediate step and
 delete it after conversion is complete.
@@ -32,6 +74,65 @@ def show_usage():
     print usage
     sys.exit()
 
+def select(exporter):
+    "Apply the -c, -r and --players flags to exporter, and return it."
+    def flag(name):
+        return groups[name][0] if groups.has_key(name) else None
+    try:
+        exporter.select(chapters=flag("-c"), entries=flag("-r"),
+                        players=flag("--players"))
+    except Exception as e:
+        print e
+        sys.exit(1)
+    return exporter
+
+def make_exporter(format):
+    "Return the exporter for format, with the flags which apply to it."
+    if format not in exporter_classes:
+        show_usage()
+    exporter = select(exporter_classes[format]())
+    if format == "html":
+        exporter.stats_page = groups.has_key("--stats")
+    elif format == "site" and groups.has_key("-p"):
+        exporter.page_size = int(groups["-p"][0])
+    return exporter
+
+def export_formats(formats):
+    """Export to several formats in one pass, each into its own folder of
+    output_path (or, for an ebook, a file named after output_path)."""
+    if "epub" in formats and "mobi" in formats:
+        print "Choose epub or mobi; the mobi is built by way of the epub."
+        sys.exit(1)
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+    book_name = os.path.basename(os.path.normpath(output_path))
+
+    multi_exporter = log_conversion.MultiExporter()
+    for format in formats:
+        exporter = make_exporter(format)
+        if format in ("epub", "mobi"):
+            plan = exporter.plan_book(
+                input_path, os.path.join(output_path,
+                                         "%s.%s" % (book_name, format)),
+                pandoc=groups.has_key("--pandoc"))
+        elif format == "html":
+            plan = exporter.plan_directory(input_path,
+                                           os.path.join(output_path, format),
+                                           incremental=groups.has_key("-u"))
+        else:
+            plan = exporter.plan_directory(input_path,
+                                           os.path.join(output_path, format))
+        multi_exporter.add(exporter, plan)
+    multi_exporter.run(jobs)
+
+exporter_classes = {
+    "text": log_conversion.LogExporter,
+    "html": log_conversion.HTMLExporter,
+    "site": log_conversion.SiteExporter,
+    "epub": log_conversion.EpubExporter,
+    "mobi": log_conversion.MobiExporter,
+}
+
 if args.get(0) is "--help":
     show_usage()
 else:
@@ -43,19 +144,22 @@ else:
         format = groups["-f"][0] if groups.has_key("-f") else "text"
         input_path = groups["-i"][0]
         output_path = groups["-o"][0]
+        jobs = int(groups["-j"][0]) if groups.has_key("-j") else 1
+
+    if "," in format:
+        export_formats(format.split(","))
 
-    if format == "text":
-        exporter = log_conversion.LogExporter()
-        exporter.output_directory(input_path, output_path)
+    elif format in ("text", "site"):
+        make_exporter(format).output_directory(input_path, output_path, jobs)
 
     elif format == "html":
-        exporter = log_conversion.HTMLExporter()
-        exporter.output_directory(input_path, output_path)
+        make_exporter(format).output_directory(
+            input_path, output_path, incremental=groups.has_key("-u"),
+            jobs=jobs)
 
-    elif format == "epub":
-        exporter = log_conversion.EpubExporter()
-        exporter.output_book(input_path, output_path)
+    elif format in ("epub", "mobi"):
+        make_exporter(format).output_book(input_path, output_path, jobs,
+                                          pandoc=groups.has_key("--pandoc"))
 
-    elif format == "mobi":
-        exporter = log_conversion.MobiExporter()
-        exporter.output_book(input_path, output_path)
+    else:
+        show_usage()
@@ -1,19 +1,87 @@
 # Command-line program which imports log files to create JSON output;
 # this output can then be fed to export.py.
-from log_conversion import LogImporter
+from log_conversion import LogImporter, log_levels
+from search_index import SearchIndex
 from clint import args
 
 usage = """
 Reads all files from input_dir and generates JSON files in output_dir with
 equivalent names.
 
-Usage: python import.py input_dir output_dir
+Flags:
+
+--jobs N [optional] Import files on N worker processes. Defaults to 1. An
+OpenRPG or text log of 16MB or more is instead split into pieces at line
+breaks, which are parsed on all N workers, so one huge session doesn't take as
+long as it would on one.
+
+--split-size MB [optional] With --jobs, split logs of this many megabytes or
+more, rather than 16.
+
+--force [optional] Re-import every file. Otherwise, files which haven't changed
+since the last import into output_dir are skipped.
+
+--jsonl [optional] Write JSON Lines (.jsonl) files, one entry per line, streaming
+each entry out as it is parsed. export.py reads either format.
+
+--archive path [optional] After importing, also pack every JSON file in
+output_dir into a single compact archive at path. export.py accepts the archive
+in place of a directory of JSON files.
+
+--index index_dir [optional] After importing, bring the search index in
+index_dir up to date with output_dir; see search.py.
+
+--log path [optional] Log progress to path. With --jobs, each worker process
+logs to its own file, named after path.
+
+--log-level level [optional] "debug", "info" or "warning". Defaults to "info";
+"debug" also logs every line parsed.
+
+--report path [optional] Save a JSON report of the import at path: for each
+file, and in total, how many lines each pattern matched, how many matched
+nothing, and the time spent reading, classifying, parsing and writing.
+
+--compare-parsers input_dir Instead of importing, parse every OpenRPG log in
+input_dir with and without BeautifulSoup, and report any lines where the two
+disagree.
+
+Usage: python import.py input_dir output_dir [--jobs N] [--split-size MB]
+                                             [--jsonl] [--force]
+                                             [--archive path] [--index index_dir]
+                                             [--log path] [--report path]
+       python import.py --compare-parsers input_dir
 """
 
-if args.get(0) is "--help" or len(args) != 2:
+groups = dict(args.grouped)
+positional = groups["_"].all
+
+if args.get(0) is "--help":
+    print usage
+elif groups.has_key("--compare-parsers"):
+    importer = LogImporter()
+    importer.compare_parsers(groups["--compare-parsers"][0])
+elif len(positional) != 2:
     print usage
 else:
-    input_dir, output_dir = list(args[0:])
+    input_dir, output_dir = positional
+    jobs = int(groups["--jobs"][0]) if groups.has_key("--jobs") else 1
 
     importer = LogImporter()
-    importer.process_directory(input_dir, output_dir)
+    if groups.has_key("--split-size"):
+        importer.split_size = int(float(groups["--split-size"][0]) *
+                                  1024 * 1024)
+    if groups.has_key("--jsonl"):
+        importer.output_extension = ".jsonl"
+    if groups.has_key("--log"):
+        importer.log_filename = groups["--log"][0]
+    if groups.has_key("--log-level"):
+        importer.log_level = log_levels[groups["--log-level"][0]]
+    importer.process_directory(input_dir, output_dir, jobs=jobs,
+                               force=groups.has_key("--force"))
+    importer.stop_logging()
+    if groups.has_key("--report"):
+        importer.stats.save(groups["--report"][0])
+    if groups.has_key("--archive"):
+        importer.write_archive(output_dir, groups["--archive"][0])
+    if groups.has_key("--index"):
+        SearchIndex(groups["--index"][0]).update(output_dir)
@@ -0,0 +1,96 @@
+# Counters and timings gathered while importing, so that slow stages and lines
+# which no pattern recognises can be found without a profiler. LogImporter
+# fills in one report per file; ImportStats sums them up and saves the lot as
+# JSON.
+import json
+
+# where the time goes while importing a file:
+#   read      reading the input file
+#   classify  deciding what, if anything, each line or row is
+#   parse     turning it into a log entry
+#   write     writing the JSON (and its entry index)
+# A log parsed in pieces on worker processes (see LogImporter.iter_split_log)
+# also gets worker_seconds: the workers' read, classify and parse times, summed
+# across workers, so they can add up to more than the file took. Its own
+# seconds are wall time, with the time spent waiting for the workers counted
+# as parsing.
+stages = ("read", "classify", "parse", "write")
+
+
+def new_file_report(filename, log_format):
+    return {
+        "file": filename,
+        "format": log_format,
+        "lines": 0,       # input lines, or rows for Campfire transcripts
+        "entries": 0,
+        "unmatched": 0,   # lines no pattern recognised, and so skipped
+        "pattern_hits": {},
+        "seconds": dict((stage, 0.0) for stage in stages),
+        "worker_seconds": dict((stage, 0.0) for stage in stages),
+        "error": None,
+    }
+
+
+class ImportStats(object):
+    """Per-file import reports, and totals across them."""
+
+    def __init__(self):
+        self.files = []
+        self.current = None  # report for the file being imported
+
+    def start_file(self, filename, log_format):
+        self.current = new_file_report(filename, log_format)
+        return self.current
+
+    def finish_file(self, seconds, entry_count, error=None):
+        """Complete the current file's report, with the wall time it took."""
+        report = self.current
+        report["entries"] = entry_count
+        report["error"] = error
+        report["seconds"]["total"] = seconds
+        self.files.append(report)
+        self.current = None
+        return report
+
+    def add_file(self, report):
+        """Add a report made elsewhere, e.g. by a worker process."""
+        if report is not None:
+            self.files.append(report)
+
+    def totals(self):
+        totals = new_file_report(None, None)
+        del totals["file"], totals["format"], totals["error"]
+        totals["files"] = len(self.files)
+        totals["failures"] = 0
+        totals["seconds"]["total"] = 0.0
+        for report in self.files:
+            for key in ("lines", "entries", "unmatched"):
+                totals[key] += report[key]
+            for name, hits in report["pattern_hits"].iteritems():
+                totals["pattern_hits"][name] = (
+                    totals["pattern_hits"].get(name, 0) + hits)
+            for key in ("seconds", "worker_seconds"):
+                for stage, seconds in report.get(key, {}).iteritems():
+                    totals[key][stage] += seconds
+            if report["error"] is not None:
+                totals["failures"] += 1
+        return totals
+
+    def summary(self):
+        """One line on coverage and where the time went."""
+        totals = self.totals()
+        summary = "%d lines, %d unmatched; %s" % (
+            totals["lines"], totals["unmatched"], ", ".join(
+                "%s %.2fs" % (stage, totals["seconds"][stage])
+                for stage in stages))
+        if any(totals["worker_seconds"].values()):
+            summary += "; on workers, %s" % ", ".join(
+                "%s %.2fs" % (stage, totals["worker_seconds"][stage])
+                for stage in stages[:3])
+        return summary
+
+    def save(self, filename):
+        output_file = file(filename, "w")
+        json.dump({"totals": self.totals(), "files": self.files}, output_file,
+                  indent=2, sort_keys=True)
+        output_file.close()
@@ -5,8 +5,30 @@ import re
 import json
 import codecs
 import subprocess
+import time
+import zipfile
+import uuid
+import htmlentitydefs
+import itertools
+import collections
+import gzip
+import multiprocessing
+import hashlib
+from cStringIO import StringIO
+from xml.sax.saxutils import escape
 from BeautifulSoup import BeautifulSoup
+from manifest import Manifest, file_hash
+from lru import LRUCache
+from instrumentation import ImportStats, new_file_report
+from entry_index import EntryIndex, EntryIndexWriter, index_filename
+import archive
 import template
+from log_entry import LogEntry, TEXT, STATEMENT, EMOTE, from_dict
+
+try:
+    import brotli
+except ImportError:
+    brotli = None  # SiteExporter then writes only .gz files
 
 
 def sort(input_list):
@@ -17,6 +39,234 @@ def sort(input_list):
     return output_list
 
 
+# LogImporter.log levels; messages below log_level are dropped
+log_levels = {"debug": 10, "info": 20, "warning": 30}
+
+
+def log_value(value):
+    """A log field's value as JSON. Logging mustn't stop an import, so bytes
+    which aren't UTF-8 are replaced, and anything JSON can't hold is logged as
+    its repr."""
+    if isinstance(value, str):
+        value = value.decode("utf-8", "replace")
+    try:
+        return json.dumps(value)
+    except (TypeError, ValueError):
+        return json.dumps(repr(value))
+
+
+def read_json_entries(filename):
+    """Return a generator which reads the LogEntries in a JSON or JSON Lines
+    file lazily, decoding one entry at a time."""
+    if filename.endswith(".jsonl"):
+        return (from_dict(json.loads(line)) for line in file(filename)
+                if line.strip())
+    return itertools.imap(from_dict, iter_json_array(file(filename)))
+
+
+def iter_json_array(input_file, block_size=65536):
+    """Generate the items of the JSON array in input_file, reading it a block
+    at a time, so that only one item is ever decoded and held in memory."""
+    raw_decode = json.JSONDecoder().raw_decode
+    whitespace = re.compile(r"[ \t\n\r]*")
+    comma = re.compile(r"[ \t\n\r]*,[ \t\n\r]*")
+    number_terminators = " \t\n\r,]"
+    buffer = ""
+    position = 0
+    at_end = False
+    need_more = False
+    expecting = "["  # then the first item or "]", then "," or "]"
+
+    while True:
+        if need_more:
+            if at_end:
+                raise ValueError("Unexpected end of JSON array")
+            block = input_file.read(block_size)
+            at_end = not block
+            buffer = buffer[position:] + block
+            position = 0
+            need_more = False
+
+        position = whitespace.match(buffer, position).end()
+        if position == len(buffer):
+            need_more = True
+            continue
+
+        char = buffer[position]
+        if expecting == "[":
+            if char != "[":
+                raise ValueError("Expected a JSON array")
+            position += 1
+            expecting = "first"
+        elif char == "]" and expecting in ("first", ","):
+            input_file.close()
+            return
+        elif expecting == ",":
+            if char != ",":
+                raise ValueError("Expected , or ] in JSON array")
+            position += 1
+            expecting = "item"
+        else:
+            # items, one after another, until the end of the buffer
+            while True:
+                try:
+                    item, end = raw_decode(buffer, position)
+                except ValueError:
+                    if at_end:
+                        raise
+                    need_more = True  # the item goes on in the next block
+                    break
+                if (isinstance(item, (int, long, float)) and not at_end and
+                        (end == len(buffer) or
+                         buffer[end] not in number_terminators)):
+                    # a number split between blocks decodes as its first
+                    # part, e.g. -2500.0 as -25 or -2500; it's only complete
+                    # once something which can't continue it follows
+                    need_more = True
+                    break
+                yield item
+                match = comma.match(buffer, end)
+                if match is None or match.end() == len(buffer):
+                    position = end
+                    expecting = ","
+                    break
+                position = match.end()
+                expecting = "item"
+
+
+# Worker processes can't share the parent's importer (bound methods don't
+# pickle), so each one builds its own in the pool initializer below.
+_worker_importer = None
+
+
+def _init_import_worker(importer_class, log_filename, log_level):
+    """Pool initializer: create this worker's importer. Each worker logs to its
+    own file, named after the process, so no log state is shared."""
+    global _worker_importer
+    _worker_importer = importer_class()
+    _worker_importer.log_level = log_level
+    if log_filename is not None:
+        base, extension = os.path.splitext(log_filename)
+        worker_name = multiprocessing.current_process().name
+        _worker_importer.log_filename = "%s.%s%s" % (base, worker_name,
+                                                     extension)
+        _worker_importer.start_logging()
+
+
+def _parse_chunk_worker(chunk):
+    """Parse one piece of a log; return its entries and its report, for the
+    parent to add to the file's."""
+    input_file, log_format, start, end = chunk
+    report = new_file_report(input_file, log_format)
+    entries = list(_worker_importer.parse_chunk(input_file, log_format, start,
+                                                end, report))
+    return (entries, report)
+
+
+def _import_file_worker(filenames):
+    """Import one file; return the import_file result and the file's report,
+    which the parent adds to its own stats."""
+    input_filename, output_filename = filenames
+    result = _worker_importer.import_file(input_filename, output_filename)
+    _worker_importer.flush_log()
+    report = (_worker_importer.stats.files.pop()
+              if _worker_importer.stats.files else None)
+    return (result, report)
+
+
+# likewise for exporting; see LogExporter.export_files
+_worker_exporter = None
+
+
+def _init_export_worker(exporter_class, settings):
+    global _worker_exporter
+    _worker_exporter = exporter_class()
+    for name, value in settings.items():
+        setattr(_worker_exporter, name, value)
+
+
+def _export_file_worker(task):
+    input_filename, output_filename, options = task
+    return _worker_exporter.export_file(input_filename, output_filename,
+                                        options)
+
+
+# and for MultiExporter, one exporter for each format
+_worker_exporters = None
+
+
+def _init_multi_export_worker(specs):
+    global _worker_exporters
+    _worker_exporters = []
+    for exporter_class, settings in specs:
+        exporter = exporter_class()
+        for name, value in settings.items():
+            setattr(exporter, name, value)
+        _worker_exporters.append(exporter)
+
+
+def _export_chapter_worker(chapter):
+    input_filename, chapter_tasks = chapter
+    return export_chapter(_worker_exporters, input_filename, chapter_tasks)
+
+
+def export_chapter(exporters, input_filename, chapter_tasks):
+    """Read the chapter once, handing each batch of entries to the chapter
+    writer of every (exporter number, task) of chapter_tasks in turn, so that
+    the chapter is never held in memory. Returns each task's error, or
+    None."""
+    writers = [exporters[n].chapter_writer(task_input_filename,
+                                           output_filename, **options)
+               for n, (task_input_filename, output_filename, options)
+               in chapter_tasks]
+    reader = exporters[chapter_tasks[0][0]]
+    errors = write_chapter(writers, reader.read_entries(input_filename))
+    return [error and "%s: %s" % (error.__class__.__name__, error)
+            for error in errors]
+
+
+def write_chapter(writers, entries, batch_size=1000):
+    """Send entries to each of writers (see LogExporter.chapter_writer) in
+    lists of up to batch_size, then None to finish. A writer which fails is
+    dropped, and the others carry on. Returns the exception each writer
+    raised, or None."""
+    errors = [None] * len(writers)
+    writing = []  # numbers of the writers still going
+    for n, writer in enumerate(writers):
+        try:
+            next(writer)
+            writing.append(n)
+        except Exception as e:
+            errors[n] = e
+
+    entries = iter(entries)
+    while writing:
+        try:
+            batch = list(itertools.islice(entries, batch_size))
+        except Exception as e:
+            for n in writing:
+                errors[n] = e
+                writers[n].close()
+            return errors
+        if not batch:
+            break
+        for n in list(writing):
+            try:
+                writers[n].send(batch)
+            except Exception as e:
+                errors[n] = e
+                writing.remove(n)
+
+    for n in writing:
+        try:
+            writers[n].send(None)
+        except StopIteration:
+            pass  # finished, as it should
+        except Exception as e:
+            errors[n] = e
+    return errors
+
+
 # "importing" in this case means converting the data from its mishmash
 # of formats and storing it all in consistent JSON files; from there,
 # it can be exported to plaintext, HTML, ebook, etc.
@@ -24,30 +274,120 @@ class LogImporter(object):
     """Converts OpenRPG log lines, files, or whole directories to JSON data."""
 
     def __init__(self):
+        # Bump this whenever a change would alter the JSON produced from the
+        # same input; incremental imports then redo every file.
+        self.version = 1
+        # records what each output file was built from; see process_directory
+        self.manifest_basename = ".import_manifest"
+
         self.extension_pattern = r"\.(html|txt)$"
+        # ".jsonl" writes JSON Lines, streaming entries out as they're parsed
+        self.output_extension = ".json"
+        # write an entry index beside each JSON file; see entry_index.py
+        self.write_entry_index = True
         # openRPG timestamp pattern
         self.timestamp_pattern = r"^\[.+\d{4}\] : "
         # if present in the first 10 lines, this is a Campfire log
         self.campfire_log_pattern = r"^\s+<title>Campfire"
-
-        # openRPG content patterns, through the years
+        # Campfire transcripts are scanned for message rows without building a
+        # soup of the whole document; see iter_campfire_log
+        self.campfire_row_class_pattern = re.compile(r"^text_message.+")
+        self.campfire_row_start_pattern = re.compile(r"<tr\b([^>]*)>", re.I)
+        self.campfire_row_end_pattern = re.compile(r"</tr\s*>|<tr\b|</table",
+                                                   re.I)
+        self.class_attribute_pattern = re.compile(
+            r"\bclass\s*=\s*(?:\"([^\"]*)\"|'([^']*)'|([^\s>]+))", re.I)
+        self.charset_pattern = re.compile(r"<meta[^>]+charset=[\"']?([\w-]+)",
+                                          re.I)
+        self.campfire_block_size = 65536
+
+        # openRPG content patterns, through the years. They're anchored at the
+        # end of the timestamp by the dispatcher, and must be mutually
+        # exclusive, since the dispatcher may try them in any order: hence the
+        # lookaheads which stop v2 patterns from also matching v1 lines.
         self.content_patterns = (
-            (r"^<[Bb]>\(\d+\) (.+)</[Bb]>: <font", self.statement_v1),
-            (r"^<[Bb]>(.+)</[Bb]>: <font", self.statement_v2),
-            (r"^<p><b>(.+)</b>: ", self.statement_v3),
-            (r"^<font color='#\d{6}'>\*{2} \(\d+\) ", self.emote_v1),
-            (r"^<font color='#\d{6}'>\*{2}", self.emote_v2),
-            (r"^<p>\*{2} ", self.emote_v3),
+            (r"<[Bb]>\(\d+\) (.+)</[Bb]>: <font", self.statement_v1),
+            (r"<[Bb]>(?!\(\d+\) .+</[Bb]>: <font)(.+)</[Bb]>: <font",
+             self.statement_v2),
+            (r"<p><b>(.+)</b>: ", self.statement_v3),
+            (r"<font color='#\d{6}'>\*{2} \(\d+\) ", self.emote_v1),
+            (r"<font color='#\d{6}'>\*{2}(?! \(\d+\) )", self.emote_v2),
+            (r"<p>\*{2} ", self.emote_v3),
         )
+        self.content_versions = ("v1", "v2", "v3")
+        self.line_handlers = dict((function.__name__, function)
+                                  for pattern, function in self.content_patterns)
+        self.dispatchers = {}  # compiled dispatch regexes, by version order
+        self.reset_dispatcher()
+
+        # Tag contents can be pulled out of most lines with a regex, without
+        # building a soup; see extract_fields. BeautifulSoup re-escapes bare
+        # ampersands and re-encodes non-ASCII text, so those lines get soup.
+        # Contents may have inline tags in them, which soup leaves as they are
+        # so long as they're lowercase, without attributes, and not inside
+        # another of the same name (soup would close that one first).
+        self.fast_parsing = True
+        self.soup_only_pattern = re.compile(
+            r"[^\x00-\x7f]|&(?!#\d+;|#x[0-9A-Fa-f]+;|[A-Za-z][A-Za-z0-9]*;)")
+        # soup also collapses whitespace-only strings, between tags or not, to
+        # a single space
+        self.soup_space_pattern = re.compile(r"(?:^|>)(?! (?:<|$))\s+(?:<|$)")
+        inline = self.inline_pattern(("b", "i", "u", "em", "strong"), 3)
+        self.fast_patterns = {
+            "b_font": re.compile(
+                r"<[Bb]>([^<>]*)</[Bb]>: <font[^<>]*>(%s)</font>" % inline),
+            "p_b": re.compile(r"<p><b>([^<>]*)</b>(%s)(?:</p>|$)" % inline),
+            "font": re.compile(r"<font[^<>]*>(%s)</font>" % inline),
+            "p": re.compile(r"<p>(%s)(?:</p>|$)" % inline),
+        }
+        self.soup_extractors = {
+            "b_font": lambda parsed: (parsed.b.renderContents(),
+                                      parsed.font.renderContents()),
+            # extract() also removes the <b> tag from the <p>
+            "p_b": lambda parsed: (parsed.b.extract().renderContents(),
+                                   parsed.p.renderContents()),
+            "font": lambda parsed: (parsed.font.renderContents(),),
+            "p": lambda parsed: (parsed.p.renderContents(),),
+        }
 
         self.log_file = None
         self.log_filename = None
-
-    def log(self, message):
-        if self.log_filename is not None:
-            if self.log_file is None:
-                self.log_file = file(self.log_filename, "w")
-            self.log_file.write(message + "\n")
+        # "debug" also logs every line parsed, which is slow and verbose
+        self.log_level = log_levels["info"]
+        # log messages are written out this many at a time, and when logging
+        # stops
+        self.log_buffer = []
+        self.log_buffer_size = 1000
+
+        # pattern hits, unmatched lines and stage timings; see instrumentation
+        self.stats = ImportStats()
+
+        # OpenRPG and text logs of at least split_size bytes are parsed in
+        # pieces on split_jobs worker processes; see iter_split_log.
+        # process_directory sets split_jobs from its own jobs.
+        self.split_jobs = 1
+        self.split_size = 16 * 1024 * 1024
+        # the most bytes of log a worker parses at a time
+        self.split_chunk_size = 4 * 1024 * 1024
+
+    def log(self, message, level="info", **fields):
+        """Log message, followed by any fields as key=value pairs, if level is
+        at least log_level. Messages are buffered; see flush_log."""
+        if self.log_filename is None or log_levels[level] < self.log_level:
+            return
+        if fields:
+            message += "".join(" %s=%s" % (key, log_value(fields[key]))
+                               for key in sort(fields))
+        self.log_buffer.append("%s %s\n" % (level.upper(), message))
+        if len(self.log_buffer) >= self.log_buffer_size:
+            self.flush_log()
+
+    def flush_log(self):
+        if self.log_buffer:
+            if self.log_file is None or self.log_file.closed:
+                self.open_log()
+            self.log_file.writelines(self.log_buffer)
+            self.log_buffer = []
             self.log_file.flush()
 
     def strip_timestamp(self, line):
@@ -57,45 +397,32 @@ class LogImporter(object):
         """Parses a statement in the following format:
             <B>(123) Alan</B>: <font color='#800040'>Example.</font><br>
         """
-        self.log("Parsing as v1 statement: %s" % line)
-        parsed = BeautifulSoup(line)
+        self.log("Parsing as v1 statement", "debug", line=line)
+        player, content = self.extract_fields(line, "b_font")
         # build log entry
-        return {
-            "type": "statement",
-            "player": re.sub(r"^\(\d+\) ", "", parsed.b.renderContents()),
-            "content": parsed.font.renderContents(),
-        }
+        return LogEntry(STATEMENT, content, re.sub(r"^\(\d+\) ", "", player))
 
     def statement_v2(self, line):
         """Parses a statement in the following format:
             <B>Alan</B>: <font color='#800040'>Example sentence.</font><br>
         """
 
-        self.log("Parsing as v2 statement: %s" % line)
-        parsed = BeautifulSoup(line)
+        self.log("Parsing as v2 statement", "debug", line=line)
+        player, content = self.extract_fields(line, "b_font")
         # return log entry
-        return {
-            "type": "statement",
-            "player": parsed.b.renderContents(),
-            "content": parsed.font.renderContents(),
-        }
+        return LogEntry(STATEMENT, content, player)
 
     def statement_v3(self, line):
         """Parses a statement in the following format:
             <p><b>Alan</b>: Example sentence.</p>
         """
 
-        self.log("Parsing as v3 statement: %s" % line)
-        parsed = BeautifulSoup(line)
-        player = parsed.b.extract().renderContents()  # also removes <b> tag
-        content = re.sub(r"^: ", "", parsed.p.renderContents())
+        self.log("Parsing as v3 statement", "debug", line=line)
+        player, content = self.extract_fields(line, "p_b")
+        content = re.sub(r"^: ", "", content)
 
         # return log entry
-        return {
-            "type": "statement",
-            "player": player,
-            "content": content,
-        }
+        return LogEntry(STATEMENT, content, player)
 
     def campfire_statement(self, tag):
         """Parse a statement in Campfire log HTML format. Accepts a
@@ -104,49 +431,104 @@ class LogImporter(object):
         content = tag.find("div", {"class": "body"}).renderContents()
 
         # return log entry
-        return {
-            "type": "statement",
-            "player": player,
-            "content": content,
-        }
+        return LogEntry(STATEMENT, content, player)
 
     def emote_v1(self, line):
-        self.log("Parsing as v1 emote: %s" % line)
-        parsed = BeautifulSoup(line)
-        emote = parsed.font.renderContents()  # gives raw innerHTML
+        self.log("Parsing as v1 emote", "debug", line=line)
+        emote, = self.extract_fields(line, "font")  # gives raw innerHTML
         content = re.search("^\*{2} \(\d+\) (.+) \*{2}", emote).group(1)
-        entry = {
-            "type": "emote",
-            "content": content,
-        }
-        return entry
+        return LogEntry(EMOTE, content)
 
     def emote_v2(self, line):
-        parsed = BeautifulSoup(line)
-        emote = parsed.font.renderContents()  # gives raw innerHTML
+        emote, = self.extract_fields(line, "font")  # gives raw innerHTML
         content = re.search("^\*{2} (.+) \*{2}", emote).group(1)
-        entry = {
-            "type": "emote",
-            "content": content,
-        }
-        return entry
+        return LogEntry(EMOTE, content)
 
     def emote_v3(self, line):
-        parsed = BeautifulSoup(line)
-        emote = parsed.p.renderContents()
+        emote, = self.extract_fields(line, "p")
         content = re.search("^\*{2} (.+) \*{2}", emote).group(1)
-        entry = {
-            "type": "emote",
-            "content": content
-        }
-        return entry
+        return LogEntry(EMOTE, content)
+
+    def inline_pattern(self, tags, depth):
+        """A regex for text with any of tags in it, nested up to depth deep,
+        but none inside another of the same name; it has no groups."""
+        if depth == 0 or not tags:
+            return r"[^<>]*"
+        nested = "|".join(
+            "<%s>%s</%s>" % (tag, self.inline_pattern(
+                tuple(other for other in tags if other != tag), depth - 1), tag)
+            for tag in tags)
+        # each repeat takes a whole tag, so a failed match can't backtrack
+        # through the text every possible way
+        return r"[^<>]*(?:(?:%s)[^<>]*)*" % nested
+
+    def extract_fields(self, line, kind):
+        """Return a tuple of the raw innerHTML of the tags named by kind (see
+        fast_patterns). Lines which are simple enough are handled by a regex,
+        which passes well-formed inline markup through as it is; anything
+        else, or with stray ampersands or non-ASCII text, goes through
+        BeautifulSoup, which would otherwise rewrite it differently."""
+        if self.fast_parsing and not self.soup_only_pattern.search(line):
+            match = self.fast_patterns[kind].match(line)
+            if match is not None and not [
+                    field for field in match.groups()
+                    if self.soup_space_pattern.search(field)]:
+                return match.groups()
+        return self.soup_extractors[kind](BeautifulSoup(line))
 
     def process_openRPG_line(self, line):
-        line = self.strip_timestamp(line.strip())
-        for pattern, function in self.content_patterns:
-            if re.search(pattern, line):
-                return function(line)
-        return None  # if nothing matched
+        match = self.dispatcher.match(line.strip())
+        if match is None:
+            return None  # if nothing matched
+
+        # the matching format's group is the last one to close
+        handler_name = match.lastgroup
+        self.count_version_hit(handler_name[-2:])
+        return self.line_handlers[handler_name](
+            match.string[match.start(handler_name):])
+
+    def build_dispatcher(self, version_order):
+        """Compile one regex which skips the timestamp and identifies the line
+        format in a single match, trying the formats of each version in
+        version_order in turn. Each format is a group named after its
+        handler."""
+        # The timestamp is captured in a lookahead and then consumed by
+        # backreference, which keeps the match from backtracking into it: like
+        # strip_timestamp, this always removes the longest timestamp.
+        prefix = r"(?:(?=(?P<timestamp>%s))(?P=timestamp))?" % (
+            self.timestamp_pattern)
+        alternatives = []
+        for version in version_order:
+            for pattern, function in self.content_patterns:
+                if function.__name__.endswith("_" + version):
+                    alternatives.append("(?P<%s>%s)" % (function.__name__,
+                                                        pattern))
+        return re.compile("%s(?:%s)" % (prefix, "|".join(alternatives)))
+
+    def reset_dispatcher(self):
+        """Forget format statistics and go back to trying the oldest format
+        first. Called at the start of each file."""
+        self.version_hits = dict((version, 0)
+                                 for version in self.content_versions)
+        self.set_version_order(self.content_versions)
+
+    def set_version_order(self, version_order):
+        if version_order not in self.dispatchers:
+            self.dispatchers[version_order] = self.build_dispatcher(
+                version_order)
+        self.version_order = version_order
+        self.dispatcher = self.dispatchers[version_order]
+
+    def count_version_hit(self, version):
+        """Record a match for version; if it has now matched more often than
+        the version currently tried first, try it first from now on."""
+        self.version_hits[version] += 1
+        leader = self.version_order[0]
+        if version != leader and (self.version_hits[version] >
+                                  self.version_hits[leader]):
+            self.set_version_order(tuple(sorted(
+                self.content_versions,
+                key=lambda v: self.version_hits[v], reverse=True)))
 
     def is_campfire_log(self, filename):
         """True if campfire_log_pattern is found in the first 10 lines."""
@@ -161,75 +543,576 @@ class LogImporter(object):
         return filename.endswith(".txt")
 
     def process_file(self, input_file, output_file):
-        self.log("Processing file: %s -> %s" % (input_file, output_file))
+        """Convert input_file to JSON and return the number of entries. If
+        output_file ends with .jsonl, entries are written one per line, rather
+        than as a single JSON list."""
+        self.log("Processing file", input=input_file, output=output_file)
         print "Processing file: %s -> %s" % (input_file, output_file)
 
+        return self.write_json(self.iter_entries(input_file), output_file)
+
+    def iter_entries(self, input_file):
+        """Return an iterator over the log entries in input_file."""
         if self.is_campfire_log(input_file):
-            self.log("Converting from Campfire transcript to JSON...")
-            log_entries = self.process_campfire_log(input_file)
+            self.log("Converting to JSON", format="campfire")
+            return self.iter_campfire_log(input_file)
         elif self.is_text_log(input_file):
-            self.log("Converting from text format to JSON...")
-            log_entries = self.process_text_log(input_file)
+            self.log("Converting to JSON", format="text")
+            return self.iter_text_log(input_file)
         else:
-            self.log("Converting from OpenRPG log to JSON...")
-            log_entries = self.process_openRPG_log(input_file)
-
-        json.dump(log_entries, file(output_file, "w"))
+            self.log("Converting to JSON", format="openRPG")
+            return self.iter_openRPG_log(input_file)
+
+    def write_json(self, log_entries, output_file):
+        """Write each entry as soon as it arrives, so only one entry need be in
+        memory at a time: as a JSON list, just as json.dump would, or if
+        output_file ends with .jsonl, one entry per line. Unless
+        write_entry_index is False, also writes an index of where each entry
+        is (see entry_index.py). Returns the number written."""
+        json_lines = output_file.endswith(".jsonl")
+        index = None
+        if self.write_entry_index:
+            index = EntryIndexWriter(index_filename(output_file))
+
+        count = 0
+        offset = 0  # where the next entry starts
+        digest = hashlib.sha1()  # of the JSON, for the index
+        # by way of a temporary file, so a failed import leaves any earlier
+        # output alone, and no half-written JSON for the exporters
+        temp_filename = output_file + ".tmp"
+        output = file(temp_filename, "w")
+
+        def write(data):
+            output.write(data)
+            digest.update(data)
+
+        # time spent here rather than in log_entries, for the stats
+        report = self.stats.current
+        clock = time.time
+        writing = 0.0
+
+        try:
+            started = clock()
+            if not json_lines:
+                write("[")
+                offset += 1
+            writing += clock() - started
+            for entry in log_entries:
+                started = clock()
+                if count > 0 and not json_lines:
+                    write(", ")
+                    offset += 2
+                data = json.dumps(entry.to_dict())
+                write(data)
+                if index is not None:
+                    index.add(offset, len(data), entry)
+                offset += len(data)
+                if json_lines:
+                    write("\n")
+                    offset += 1
+                count += 1
+                writing += clock() - started
+            started = clock()
+            if not json_lines:
+                write("]")
+                offset += 1
+            output.close()
+            # the index goes in first; if the JSON then fails to, the index
+            # doesn't match the JSON which is there, and isn't used
+            if index is not None:
+                index.close(temp_filename, digest.hexdigest())
+            writing += clock() - started
+            if report is not None:
+                report["seconds"]["write"] += writing
+        except:
+            output.close()
+            os.remove(temp_filename)
+            raise
+        os.rename(temp_filename, output_file)
+        return count
+
+    def import_file(self, input_file, output_file):
+        """Run process_file, but report failure instead of raising. Returns an
+        (input_file, entry_count, error) tuple; error is None on success. The
+        file's report is added to stats."""
+        self.stats.start_file(input_file, None)
+        start = time.time()
+        try:
+            result = (input_file, self.process_file(input_file, output_file),
+                      None)
+        except Exception as e:
+            self.log("Failed to import", "warning", input=input_file,
+                     error=str(e))
+            result = (input_file, 0, "%s: %s" % (e.__class__.__name__, e))
+        self.stats.finish_file(time.time() - start, result[1], result[2])
+        return result
 
     def process_campfire_log(self, input_file):
         """Parse Campfire HTML transcript and return log entries."""
-        parsed = BeautifulSoup(file(input_file).read())
-        statements = parsed.findAll("tr", {
-            "class": re.compile(r"^text_message.+")
-        })
-        return [self.campfire_statement(statement)
-                for statement in statements]
+        return list(self.iter_campfire_log(input_file))
+
+    def iter_campfire_log(self, input_file):
+        """Generator version of process_campfire_log. Reads the transcript a
+        block at a time and yields an entry for each tr.text_message* row as
+        soon as the row is complete, so only one row is ever held in memory.
+        Each row gets its own small soup, decoded with the document's charset
+        so that it comes out as it would from a soup of the whole document."""
+        report = self.file_report("campfire")
+        seconds = report["seconds"]
+        clock = time.time
+
+        input = file(input_file)
+        blocks = iter(lambda: input.read(self.campfire_block_size), "")
+        buffer = ""
+        encoding = None
+        position = 0  # everything before this has been dealt with
+
+        # time outside reading blocks and parsing rows goes to scanning for
+        # rows, i.e. classify; mark is when the time was last accounted for
+        mark = clock()
+        # the final None lets rows still open at the end of the file be closed
+        for block in itertools.chain(blocks, [None]):
+            now = clock()
+            seconds["read"] += now - mark
+            mark = now
+            at_end = block is None
+            buffer = buffer[position:] + (block or "")
+            position = 0
+            if encoding is None:
+                match = self.charset_pattern.search(buffer)
+                if match is not None:
+                    encoding = match.group(1)
+
+            while True:
+                start = self.campfire_row_start_pattern.search(buffer, position)
+                if start is None:
+                    # keep any partial tag for the next block
+                    position = max(position, buffer.rfind("<"))
+                    break
+                end = self.campfire_row_end_pattern.search(buffer, start.end())
+                if end is None or end.end() == len(buffer):
+                    if not at_end:
+                        # the row, or the tag ending it, continues in the next
+                        # block
+                        position = start.start()
+                        break
+                if end is None:
+                    row_end = next_position = len(buffer)
+                elif end.group(0).lower().startswith("<tr"):
+                    # a new row implicitly ends this one
+                    row_end = next_position = end.start()
+                else:
+                    row_end, next_position = end.start(), end.end()
+
+                report["lines"] += 1
+                if self.is_campfire_row(start.group(1)):
+                    row = buffer[start.start():row_end]
+                    parsing = clock()
+                    seconds["classify"] += parsing - mark
+                    entry = self.campfire_statement(
+                        BeautifulSoup(row, fromEncoding=encoding).tr)
+                    seconds["parse"] += clock() - parsing
+                    yield entry
+                    mark = clock()
+                else:
+                    report["unmatched"] += 1
+                position = next_position
+
+            now = clock()
+            seconds["classify"] += now - mark
+            mark = now
+
+        input.close()
+
+    def is_campfire_row(self, attributes):
+        """True if a <tr> tag's attributes give it a text_message* class."""
+        match = self.class_attribute_pattern.search(attributes)
+        return match is not None and self.campfire_row_class_pattern.search(
+            match.group(1) or match.group(2) or match.group(3) or "")
 
     # this case is so simple we don't need line processing functions
     def process_text_log(self, input_file):
         """Break text file into paragraphs and return one entry per para."""
-        lines = [line.strip() for line in file(input_file).readlines()]
-        lines = filter(None, lines)  # filter out empty lines
-        return [{"type": "text", "content": line} for line in lines]
+        return list(self.iter_text_log(input_file))
+
+    def iter_text_log(self, input_file):
+        """Generator version of process_text_log; reads the file lazily, or
+        if it's big enough, in pieces on worker processes (see
+        iter_split_log)."""
+        if self.should_split(input_file):
+            return self.iter_split_log(input_file, "text")
+        return self.parse_text_lines(file(input_file),
+                                     self.file_report("text"))
+
+    def parse_text_lines(self, lines, report):
+        seconds = report["seconds"]
+        clock = time.time
+        resumed = clock()
+        for line in lines:
+            # time spent in the loop header, i.e. reading
+            seconds["read"] += clock() - resumed
+            report["lines"] += 1
+            line = line.strip()
+            if line:  # filter out empty lines
+                yield LogEntry(TEXT, line)
+            resumed = clock()
 
     def process_openRPG_log(self, input_file):
-        input_lines = file(input_file).readlines()
-        output_lines = [self.process_openRPG_line(line) for line in input_lines]
-        return filter(None, output_lines)  # remove None elements
-
-    def process_directory(self, input_dir, output_dir):
-        self.log("Processing dir: %s -> %s" % (input_dir, output_dir))
+        return list(self.iter_openRPG_log(input_file))
+
+    def iter_openRPG_log(self, input_file):
+        """Generator version of process_openRPG_log; reads the file lazily, or
+        if it's big enough, in pieces on worker processes (see
+        iter_split_log)."""
+        if self.should_split(input_file):
+            return self.iter_split_log(input_file, "openRPG")
+        return self.parse_openRPG_lines(file(input_file),
+                                        self.file_report("openRPG"))
+
+    def parse_openRPG_lines(self, lines, report):
+        """Does the same as process_openRPG_line for each line, but counts
+        hits into report and times each stage as it goes."""
+        self.reset_dispatcher()
+        seconds = report["seconds"]
+        hits = report["pattern_hits"]
+        clock = time.time
+        resumed = clock()
+        for line in lines:
+            started = clock()
+            seconds["read"] += started - resumed
+            report["lines"] += 1
+
+            match = self.dispatcher.match(line.strip())
+            classified = clock()
+            seconds["classify"] += classified - started
+            if match is None:  # skip lines which matched nothing
+                report["unmatched"] += 1
+                resumed = classified
+                continue
+
+            handler_name = match.lastgroup
+            hits[handler_name] = hits.get(handler_name, 0) + 1
+            self.count_version_hit(handler_name[-2:])
+            entry = self.line_handlers[handler_name](
+                match.string[match.start(handler_name):])
+            seconds["parse"] += clock() - classified
+            yield entry
+            resumed = clock()
+
+    def should_split(self, input_file):
+        return (self.split_jobs > 1 and
+                os.path.getsize(input_file) >= self.split_size)
+
+    def iter_split_log(self, input_file, log_format):
+        """Parse input_file, an OpenRPG or text log, a piece at a time on
+        split_jobs worker processes, generating the entries in their original
+        order. Each piece is a range of whole lines of at most about
+        split_chunk_size bytes. Only a couple of pieces per worker are handed
+        out ahead of the one being written, so however big the file, only
+        those pieces' entries are held at once."""
+        report = self.file_report(log_format)
+        size = os.path.getsize(input_file)
+        chunk_count = max(self.split_jobs,
+                          -(-size // max(self.split_chunk_size, 1)))
+        chunks = iter([(input_file, log_format, start, end) for start, end
+                       in self.split_file(input_file, chunk_count)])
+        self.log("Splitting file", input=input_file, chunks=chunk_count)
+        pool = multiprocessing.Pool(self.split_jobs, _init_import_worker,
+                                    (self.__class__, None, self.log_level))
+        pending = collections.deque()
+        try:
+            for chunk in itertools.islice(chunks, self.split_jobs * 2):
+                pending.append(pool.apply_async(_parse_chunk_worker, (chunk,)))
+            while pending:
+                waiting = time.time()
+                entries, chunk_report = pending.popleft().get()
+                report["seconds"]["parse"] += time.time() - waiting
+                # keep the workers busy while these entries are written
+                for chunk in itertools.islice(chunks, 1):
+                    pending.append(
+                        pool.apply_async(_parse_chunk_worker, (chunk,)))
+                for key in ("lines", "unmatched"):
+                    report[key] += chunk_report[key]
+                for name, hits in chunk_report["pattern_hits"].iteritems():
+                    report["pattern_hits"][name] = (
+                        report["pattern_hits"].get(name, 0) + hits)
+                for stage, seconds in chunk_report["seconds"].iteritems():
+                    report["worker_seconds"][stage] += seconds
+                for entry in entries:
+                    yield entry
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def split_file(self, input_file, chunk_count):
+        """Return (start, end) byte ranges dividing input_file into about
+        chunk_count pieces, each ending at a line break (or the end)."""
+        size = os.path.getsize(input_file)
+        log_file = file(input_file, "rb")
+        boundaries = [0]
+        for n in range(1, chunk_count):
+            # the line which the byte before the target is in ends the chunk
+            log_file.seek(max(size * n // chunk_count - 1, boundaries[-1]))
+            log_file.readline()
+            if boundaries[-1] < log_file.tell() < size:
+                boundaries.append(log_file.tell())
+        log_file.close()
+        boundaries.append(size)
+        return zip(boundaries[:-1], boundaries[1:])
+
+    def parse_chunk(self, input_file, log_format, start, end, report):
+        """Generate the entries of the lines from byte start to byte end of
+        input_file, just as iter_openRPG_log or iter_text_log would."""
+        read_start = time.time()
+        log_file = file(input_file, "rb")
+        log_file.seek(start)
+        data = log_file.read(end - start)
+        log_file.close()
+        # the same lines as iterating over the file would give
+        lines = data.split("\n")
+        if lines[-1] == "":
+            lines.pop()
+        report["seconds"]["read"] += time.time() - read_start
+        if log_format == "text":
+            return self.parse_text_lines(lines, report)
+        return self.parse_openRPG_lines(lines, report)
+
+    def file_report(self, log_format):
+        """Return the stats report for the file being imported, or, if there
+        is none, a report to count into which nobody will read."""
+        report = self.stats.current
+        if report is None:
+            report = new_file_report(None, log_format)
+        report["format"] = log_format
+        return report
+
+    def process_directory(self, input_dir, output_dir, jobs=1, force=False):
+        """Import every log in input_dir. With jobs > 1, files are spread over a
+        pool of worker processes; results are still reported in filename
+        order, so the output and summary don't depend on scheduling.
+
+        A manifest in output_dir records each imported file, and files which
+        haven't changed since are skipped unless force is True. Outputs whose
+        source files have gone are deleted."""
+        self.log("Processing dir", input=input_dir, output=output_dir)
         print "Processing dir: %s -> %s" % (input_dir, output_dir)
 
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
         elif not os.path.isdir(output_dir):
-            raise "Output directory %s is not a valid directory" % output_dir
-
-        input_filenames = [filename for filename in os.listdir(input_dir)
-                           if re.search(self.extension_pattern, filename)]
-
-        for filename in input_filenames:
-            # open a new log file for each input file
-            self.start_logging()
-
-            input_filename = os.path.join(input_dir, filename)
-            output_filename = os.path.join(output_dir, filename)
-            output_filename = re.sub(self.extension_pattern,
-                                     ".json", output_filename)
-            self.process_file(input_filename, output_filename)
-
-            self.stop_logging()
+            raise Exception("Output directory %s is not a valid directory"
+                            % output_dir)
+
+        manifest = Manifest(os.path.join(output_dir, self.manifest_basename),
+                            self.version)
+        filenames = [(input_filename,
+                      self.watched_output(manifest, input_filename,
+                                          output_filename))
+                     for input_filename, output_filename
+                     in self.build_filename_pairs(input_dir, output_dir)]
+        self.prune_outputs(manifest, filenames, output_dir)
+
+        stale_filenames = [(input_filename, output_filename)
+                           for input_filename, output_filename in filenames
+                           if force or not self.is_current(
+                               manifest, input_filename, output_filename)]
+        if len(stale_filenames) < len(filenames):
+            print "Skipping %d unchanged files" % (len(filenames) -
+                                                   len(stale_filenames))
+
+        # a log big enough to hold up the rest is imported on its own, in
+        # pieces on every worker; see iter_split_log
+        split_filenames = []
+        if jobs > 1:
+            split_filenames = [
+                (input_filename, output_filename)
+                for input_filename, output_filename in stale_filenames
+                if os.path.getsize(input_filename) >= self.split_size and
+                not self.is_campfire_log(input_filename)]
+        pooled_filenames = [filenames for filenames in stale_filenames
+                            if filenames not in split_filenames]
+
+        results = {}  # by input filename
+        if jobs > 1 and len(pooled_filenames) > 1:
+            pool = multiprocessing.Pool(jobs, _init_import_worker,
+                                        (self.__class__, self.log_filename,
+                                         self.log_level))
+            for result, report in pool.imap(_import_file_worker,
+                                            pooled_filenames):
+                results[result[0]] = result
+                self.stats.add_file(report)
+            pool.close()
+            pool.join()
+            pooled_filenames = []
+
+        split_jobs = self.split_jobs
+        self.split_jobs = max(jobs, split_jobs)
+        try:
+            for input_filename, output_filename in (pooled_filenames +
+                                                    split_filenames):
+                # open a new log file for each input file
+                self.start_logging()
+                results[input_filename] = self.import_file(input_filename,
+                                                           output_filename)
+                self.stop_logging()
+        finally:
+            self.split_jobs = split_jobs
+        results = [results[input_filename]
+                   for input_filename, output_filename in stale_filenames]
+
+        for (input_filename, output_filename), (_, count, error) in zip(
+                stale_filenames, results):
+            self.update_manifest(manifest, input_filename, output_filename,
+                                 error is None)
+        manifest.save()
+
+        self.print_summary(results)
+        return results
+
+    def is_current(self, manifest, input_filename, output_filename):
+        """True if output_filename exists and was built from the current
+        contents of input_filename (all of them, if watch.py built it)."""
+        name = os.path.basename(input_filename)
+        return (os.path.exists(output_filename) and
+                manifest.is_current(name, input_filename,
+                                    output=os.path.basename(output_filename))
+                and not manifest.get(name).get("unread"))
+
+    def watched_output(self, manifest, input_filename, output_filename):
+        """Return output_filename, or if watch.py has taken input_filename
+        over, the JSON Lines file it keeps, so that one is updated instead of
+        the chapter being written twice."""
+        record = manifest.get(os.path.basename(input_filename))
+        if record is not None and record.get("watched"):
+            return os.path.join(os.path.dirname(output_filename),
+                                record["output"])
+        return output_filename
+
+    def update_manifest(self, manifest, input_filename, output_filename,
+                        succeeded):
+        """Record an import in the manifest, or forget a failed one so that it
+        is retried next time. If the output name has changed (say, from .json
+        to .jsonl), the old output is removed."""
+        name = os.path.basename(input_filename)
+        output_name = os.path.basename(output_filename)
+        previous = manifest.get(name)
+        if previous is not None and previous["output"] != output_name:
+            self.remove_output(os.path.join(os.path.dirname(output_filename),
+                                            previous["output"]))
+        if succeeded and previous is not None and previous.get("watched"):
+            manifest.record(name, input_filename, output=output_name,
+                            watched=True)
+        elif succeeded:
+            manifest.record(name, input_filename, output=output_name)
+        else:
+            manifest.remove(name)
+
+    def prune_outputs(self, manifest, filenames, output_dir):
+        """Delete the outputs of manifest entries whose sources are gone."""
+        input_names = set(os.path.basename(input_filename)
+                          for input_filename, output_filename in filenames)
+        for name in manifest.names():
+            if name not in input_names:
+                self.remove_output(os.path.join(output_dir,
+                                                manifest.get(name)["output"]))
+                manifest.remove(name)
+
+    def remove_output(self, output_filename):
+        if os.path.exists(output_filename):
+            self.log("Removing stale output", output=output_filename)
+            print "Removing stale output: %s" % output_filename
+            os.remove(output_filename)
+        if os.path.exists(index_filename(output_filename)):
+            os.remove(index_filename(output_filename))
+
+    def build_filename_pairs(self, input_dir, output_dir):
+        """Return (input, output) filename pairs for every importable file in
+        input_dir, sorted by name. Output names depend only on input names."""
+        pairs = []
+        for filename in sort(os.listdir(input_dir)):
+            if re.search(self.extension_pattern, filename):
+                output_filename = re.sub(self.extension_pattern,
+                                         self.output_extension, filename)
+                pairs.append((os.path.join(input_dir, filename),
+                              os.path.join(output_dir, output_filename)))
+        return pairs
+
+    def print_summary(self, results):
+        """Print totals for a list of import_file results, then any failures."""
+        failures = [(filename, error) for filename, count, error in results
+                    if error is not None]
+        entry_count = sum(count for filename, count, error in results)
+        summary = "Imported %d files, %d entries, %d failures" % (
+            len(results) - len(failures), entry_count, len(failures))
+        self.log(summary)
+        print summary
+        for filename, error in failures:
+            print "  Failed: %s (%s)" % (filename, error)
+        if results:
+            print "Parsed %s" % self.stats.summary()
+
+    def write_archive(self, json_dir, archive_filename):
+        """Pack every JSON or JSON Lines file in json_dir into a single archive
+        (see archive.py), which any LogExporter can read in place of json_dir.
+        Chapters are named after their JSON files, in sorted order."""
+        print "Writing archive: %s -> %s" % (json_dir, archive_filename)
+        writer = archive.ArchiveWriter(archive_filename)
+        for filename in sort(os.listdir(json_dir)):
+            if re.search(r"\.jsonl?$", filename):
+                writer.add_chapter(filename, read_json_entries(
+                    os.path.join(json_dir, filename)))
+        writer.close()
+
+    def compare_parsers(self, input_dir):
+        """Parse every line of every OpenRPG log in input_dir both with and
+        without the fast path of extract_fields, and print any lines where the
+        results differ. Returns the number of differences."""
+        fast_parsing = self.fast_parsing
+        differences = 0
+        line_count = 0
+
+        for input_filename, output_filename in self.build_filename_pairs(
+                input_dir, input_dir):
+            if (self.is_campfire_log(input_filename) or
+                    self.is_text_log(input_filename)):
+                continue
+            self.reset_dispatcher()
+            for n, line in enumerate(file(input_filename)):
+                line_count += 1
+                results = []
+                for self.fast_parsing in (True, False):
+                    try:
+                        results.append(self.process_openRPG_line(line))
+                    except Exception as e:
+                        results.append(e.__class__.__name__)
+                if results[0] != results[1]:
+                    differences += 1
+                    print "%s:%d: %s" % (input_filename, n + 1, line.strip())
+                    print "  fast: %r" % (results[0],)
+                    print "  soup: %r" % (results[1],)
+
+        self.fast_parsing = fast_parsing
+        print "Compared %d lines: %d differences" % (line_count, differences)
+        return differences
 
     # utility
     def start_logging(self):
         "Enable log statements."
         if self.log_file is None or self.log_file.closed:
             if self.log_filename is not None:
-                self.log_file = file(self.log_filename, "w")
+                self.open_log()
+
+    def open_log(self):
+        """Open log_filename: afresh the first time, and after that appending,
+        so that stopping and starting logging doesn't lose earlier files'
+        messages."""
+        mode = "w" if self.log_file is None else "a"
+        self.log_file = file(self.log_filename, mode)
 
     def stop_logging(self):
-        "Disable log statements."
+        "Disable log statements, writing out any still buffered."
+        if self.log_filename is not None:
+            self.flush_log()
         if self.log_file is not None:
             self.log_file.close()
 
@@ -241,50 +1124,322 @@ class LogExporter(object):
     simple UTF-8 text files."""
 
     def __init__(self):
-        self.entry_types = (
-            ("text", self.output_text),
-            ("statement", self.output_statement),
-            ("emote", self.output_emote)
-        )
-        self.input_extension_pattern = r".json$"
+        # handler for each entry, indexed by its type code
+        self.entry_handlers = (self.output_text, self.output_statement,
+                               self.output_emote)
+        # plain JSON lists or JSON Lines; see read_entries
+        self.input_extension_pattern = r"\.jsonl?$"
         self.output_file_extension = ".txt"
         self.line_separator = u"\n"  # Unix style
 
+        # strip_tags handles simple markup itself; see fast_strip_tags
+        self.tag_pattern = re.compile(r"</?[A-Za-z][^<>]*>")
+        self.entity_pattern = re.compile(r"&(#\d+|[A-Za-z][A-Za-z0-9]*);")
+        # anything soup treats specially: comments, declarations, stray
+        # brackets, and tags whose contents aren't parsed as markup
+        self.soup_markup_pattern = re.compile(
+            r"<(?!/?[A-Za-z][^<>]*>)|<(?:script|textarea|pre)\b", re.I)
+        self.strip_tags_cache = LRUCache(10000)
+
+        self.archives = {}  # open archives, by filename; see open_archive
+
+        # export only some chapters, entries or players; see select
+        self.chapter_selection = None  # chapter names and (first, last) numbers
+        self.entry_range = None  # (first, last) entry of each chapter, from 0
+        self.player_selection = None  # lowercase player names
+
     def output_entry(self, log_entry):
-        for entry_type, function in self.entry_types:
-            if log_entry["type"] == entry_type:
-                return function(log_entry)
-        # if no entry type existed for this entry:
-        raise "No handler for entry type %s" % log_entry["type"]
+        return self.entry_handlers[log_entry.type_code](log_entry)
 
     def output_text(self, log_entry):
-        return self.strip_tags(log_entry["content"])
+        return self.strip_tags(log_entry.content)
 
     def output_statement(self, log_entry):
-        return u"%s: %s" % (log_entry["player"],
-                           self.strip_tags(log_entry["content"]))
+        return u"%s: %s" % (log_entry.player,
+                           self.strip_tags(log_entry.content))
 
     def output_emote(self, log_entry):
-        return self.strip_tags(log_entry["content"])
-
-    def output_file(self, input_filename, output_filename):
-        """Read the JSON input file and write it as plaintext."""
-        print "Exporting file: %s -> %s" % (input_filename, output_filename)
-        lines = [self.output_entry(entry) for entry
-                 in json.load(file(input_filename))]
+        return self.strip_tags(log_entry.content)
+
+    def output_file(self, input_filename, output_filename, **options):
+        """Read the JSON input file and write it in this format (plaintext, by
+        default), a batch of entries at a time; see chapter_writer."""
+        error, = write_chapter([self.chapter_writer(input_filename,
+                                                    output_filename,
+                                                    **options)],
+                               self.read_entries(input_filename))
+        if error is not None:
+            raise error
+
+    def chapter_writer(self, input_filename, output_filename, **options):
+        """A generator which writes the chapter in input_filename to
+        output_filename from the entries sent to it: lists of them, in order,
+        then None once there are no more. output_file sends it the entries it
+        reads; MultiExporter, the entries it reads once for several formats.
+        The entries are rendered by entry_renderer, between the text from
+        chapter_frame."""
+        before, after = self.chapter_frame(input_filename, output_filename,
+                                           **options)
+        render = self.entry_renderer(output_filename)
         output_file = codecs.open(output_filename, encoding="utf-8", mode="w")
-        output_file.write(self.line_separator.join(lines))
-        output_file.write(self.line_separator)  # trailing newline is good form
-        output_file.close()
-
-    def output_directory(self, input_dir, output_dir):
+        try:
+            output_file.write(before)
+            separator = u""
+            while True:
+                entries = yield
+                if entries is None:
+                    break
+                output_file.write(separator)
+                output_file.write(self.line_separator.join(
+                    [render(entry) for entry in entries]))
+                separator = self.line_separator
+            output_file.write(after)
+        finally:
+            output_file.close()
+
+    def chapter_frame(self, input_filename, output_filename):
+        """The text written before and after a chapter's entries."""
+        return (u"", self.line_separator)  # trailing newline is good form
+
+    def entry_renderer(self, output_filename):
+        """The function which renders each of a chapter's entries."""
+        return self.output_entry
+
+    def output_directory(self, input_dir, output_dir, jobs=1):
+        tasks, finish = self.plan_directory(input_dir, output_dir)
+        self.export_files(tasks, jobs)
+        finish()
+
+    def plan_directory(self, input_dir, output_dir):
+        """Return (tasks, finish): the export_files tasks output_directory
+        runs, and a function to call once they're done, which writes whatever
+        else the format needs. MultiExporter runs several exporters' tasks
+        together."""
         # destructuring bind, in your face
         input_filenames, output_filenames = self.build_file_lists(input_dir, output_dir)
 
-        for input_filename, output_filename in zip(input_filenames, output_filenames):
-            self.output_file(input_filename, output_filename)
+        return ([(input_filename, output_filename, {})
+                 for input_filename, output_filename
+                 in zip(input_filenames, output_filenames)],
+                lambda: None)
+
+    def export_files(self, tasks, jobs=1):
+        """Call output_file(input_filename, output_filename, **options) for each
+        (input_filename, output_filename, options) task. With jobs > 1, the
+        files are written by a pool of worker processes, but progress and
+        errors are still reported in task order. If any file fails, raises
+        once all the others are done."""
+        pool = None
+        if jobs > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(jobs, _init_export_worker,
+                                        (self.__class__,
+                                         self.worker_settings()))
+            errors = pool.imap(_export_file_worker, tasks)
+        else:
+            errors = (self.export_file(*task) for task in tasks)
+
+        failures = 0
+        for (input_filename, output_filename, options), error in itertools.izip(
+                tasks, errors):
+            print self.progress_message(input_filename, output_filename)
+            if error is not None:
+                print "  Failed: %s" % error
+                failures += 1
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if failures:
+            raise Exception("%d of %d files failed to export"
+                            % (failures, len(tasks)))
+
+    def worker_settings(self):
+        """Attributes which worker processes' exporters should copy from this
+        one, as a dict; for settings changed after construction."""
+        return {
+            "chapter_selection": self.chapter_selection,
+            "entry_range": self.entry_range,
+            "player_selection": self.player_selection,
+        }
+
+    def export_file(self, input_filename, output_filename, options):
+        """Run output_file, returning an error message instead of raising, or
+        None if it succeeded."""
+        try:
+            self.output_file(input_filename, output_filename, **options)
+        except Exception as e:
+            return "%s: %s" % (e.__class__.__name__, e)
+        return None
+
+    def progress_message(self, input_filename, output_filename):
+        return "Exporting file: %s -> %s" % (input_filename, output_filename)
+
+    def read_entries(self, input_filename):
+        """Return a generator which reads the log entries in input_filename
+        lazily: a JSON or JSON Lines file, or a chapter in an archive. Only
+        the selected entries are read; see select."""
+        if self.entry_range is not None or self.player_selection is not None:
+            return self.read_selected_entries(input_filename)
+        archive_filename, chapter_name = os.path.split(input_filename)
+        if self.is_archive(archive_filename):
+            return self.open_archive(archive_filename).entries(chapter_name)
+        return read_json_entries(input_filename)
+
+    def read_selected_entries(self, input_filename):
+        """Generate the entries of input_filename in entry_range and by the
+        players in player_selection. If the chapter has an up to date entry
+        index, only those entries are read; otherwise all of them are, and the
+        rest skipped."""
+        index = self.open_entry_index(input_filename)
+        if index is not None:
+            return index.entries(input_filename,
+                                 self.selected_positions(index))
+
+        first, last = self.entry_range or (0, None)
+        archive_filename, chapter_name = os.path.split(input_filename)
+        if self.is_archive(archive_filename):
+            entries = self.open_archive(archive_filename).entries(chapter_name)
+        else:
+            entries = read_json_entries(input_filename)
+        entries = itertools.islice(entries, first,
+                                   None if last is None else last + 1)
+        if self.player_selection is None:
+            return entries
+        return (entry for entry in entries
+                if entry.player is not None and
+                entry.player.lower() in self.player_selection)
+
+    def selected_positions(self, index):
+        first, last = self.entry_range or (0, None)
+        return index.positions(first, last, self.player_selection)
+
+    def open_entry_index(self, input_filename):
+        """Return the EntryIndex for input_filename, or None if it has none,
+        or it is out of date."""
+        filename = index_filename(input_filename)
+        if not os.path.exists(filename):
+            return None
+        index = EntryIndex(filename)
+        if not index.is_current(input_filename):
+            return None
+        return index
+
+    def select(self, chapters=None, entries=None, players=None):
+        """Export only some of the logs. Each argument is a string, as given to
+        export.py:
+
+        chapters: comma-separated chapter names (with or without extension)
+        and numbers or ranges of numbers, counting from 1 in name order, e.g.
+        "40-55,60,session_12"
+
+        entries: the range of entries to export from each chapter, counting
+        from 1, e.g. "100-200", "100-" or "100"
+
+        players: comma-separated player names, whose statements alone are
+        exported; not case-sensitive"""
+        range_pattern = r"^(\d+)(?:(-)(\d*))?$"
+        if chapters is not None:
+            self.chapter_selection = []
+            for item in chapters.split(","):
+                match = re.match(range_pattern, item.strip())
+                if match is None:
+                    self.chapter_selection.append(
+                        re.sub(self.input_extension_pattern, "", item.strip()))
+                else:
+                    first, dash, last = match.groups()
+                    self.check_range(item, first, last)
+                    self.chapter_selection.append(
+                        (int(first), int(last) if last else
+                         None if dash else int(first)))
+        if entries is not None:
+            match = re.match(range_pattern, entries.strip())
+            if match is None:
+                raise Exception("Bad entry range %s; expected e.g. 100-200"
+                                % entries)
+            first, dash, last = match.groups()
+            self.check_range(entries, first, last)
+            self.entry_range = (int(first) - 1, int(last) - 1 if last else
+                                None if dash else int(first) - 1)
+        if players is not None:
+            self.player_selection = set(player.strip().lower()
+                                        for player in players.split(","))
+
+    def check_range(self, text, first, last):
+        """Raise if a range given to select doesn't count from 1, or ends
+        before it starts."""
+        if int(first) < 1:
+            raise Exception("Bad range %s; numbers count from 1" % text)
+        if last and int(last) < int(first):
+            raise Exception("Bad range %s; it ends before it starts" % text)
+
+    def select_chapters(self, filenames):
+        """Return those of the sorted chapter filenames which chapter_selection
+        picks out, in order."""
+        if self.chapter_selection is None:
+            return filenames
+        selected = []
+        for number, filename in enumerate(filenames):
+            name = re.sub(self.input_extension_pattern, "", filename)
+            for item in self.chapter_selection:
+                if isinstance(item, tuple):
+                    first, last = item
+                    if number + 1 >= first and (last is None or
+                                                number + 1 <= last):
+                        break
+                elif item == name:
+                    break
+            else:
+                continue
+            selected.append(filename)
+        return selected
+
+    def selection_key(self):
+        """A string describing the selection, for build manifests' versions:
+        empty if everything is exported."""
+        if (self.chapter_selection is None and self.entry_range is None and
+                self.player_selection is None):
+            return ""
+        return ":" + json.dumps([self.chapter_selection, self.entry_range,
+                                 sort(self.player_selection or [])])
+
+    def count_entries(self, input_filename):
+        """Return the number of entries in input_filename (only those selected;
+        see select), reading as little of it as possible."""
+        if self.entry_range is not None or self.player_selection is not None:
+            index = self.open_entry_index(input_filename)
+            if index is not None:
+                return len(self.selected_positions(index))
+            return sum(1 for entry in self.read_selected_entries(
+                input_filename))
+        archive_filename, chapter_name = os.path.split(input_filename)
+        if self.is_archive(archive_filename):
+            return self.open_archive(archive_filename).entry_count(
+                chapter_name)
+        index = self.open_entry_index(input_filename)
+        if index is not None:
+            return len(index)
+        if input_filename.endswith(".jsonl"):
+            return len([line for line in file(input_filename)
+                        if line.strip()])
+        return sum(1 for entry in read_json_entries(input_filename))
 
     # utility
+    def join_lines(self, lines, batch_size=1000):
+        """Generate the same text as line_separator.join(lines), a batch of
+        lines at a time, consuming lines as it goes."""
+        lines = iter(lines)
+        batch = list(itertools.islice(lines, batch_size))
+        while batch:
+            yield self.line_separator.join(batch)
+            batch = list(itertools.islice(lines, batch_size))
+            if batch:
+                yield self.line_separator
+
+    def render_string(self, template_filename, replacements):
+        """Render a template to a UTF-8 string."""
+        return u"".join(template.render(template_filename,
+                                        replacements)).encode("utf-8")
+
     def build_file_lists(self, input_dir, output_dir):
         self.prepare_directory(output_dir)
         input_filenames = self.build_input_filenames(input_dir)
@@ -295,12 +1450,12 @@ class LogExporter(object):
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
         elif not os.path.isdir(output_dir):
-            raise "Output directory %s is not a valid directory" % output_dir
+            raise Exception("Output directory %s is not a valid directory"
+                            % output_dir)
 
     def build_input_filenames(self, input_dir):
         return [os.path.join(input_dir, filename)
-                for filename in sort(os.listdir(input_dir))
-                if re.search(self.input_extension_pattern, filename)]
+                for filename in self.list_chapters(input_dir)]
 
     def build_output_filenames(self, input_dir, output_dir):
         # looks a bit weird, but I think it's readable!
@@ -308,10 +1463,95 @@ class LogExporter(object):
                              re.sub(self.input_extension_pattern,
                                     self.output_file_extension,
                                     filename))
-                for filename in sort(os.listdir(input_dir))]
+                for filename in self.list_chapters(input_dir)]
+
+    def list_chapters(self, input_dir):
+        """Return the sorted names of the JSON files in input_dir. input_dir
+        may also be an archive written by LogImporter.write_archive, which is
+        treated as a directory of the JSON files it was built from.
+
+        A chapter with both a .json and a .jsonl file is refused, since both
+        would be written to the same output file."""
+        if self.is_archive(input_dir):
+            filenames = self.open_archive(input_dir).chapter_names()
+        else:
+            filenames = os.listdir(input_dir)
+        filenames = [filename for filename in sort(filenames)
+                     if re.search(self.input_extension_pattern, filename)]
+        chapters = {}
+        for filename in filenames:
+            chapter = re.sub(self.input_extension_pattern, "", filename)
+            if chapter in chapters:
+                raise Exception("%s has both %s and %s in %s; remove one"
+                                % (chapter, chapters[chapter], filename,
+                                   input_dir))
+            chapters[chapter] = filename
+        return self.select_chapters(filenames)
+
+    def is_archive(self, path):
+        return path in self.archives or archive.is_archive(path)
+
+    def open_archive(self, archive_filename):
+        """Return an Archive for archive_filename, opening it only once."""
+        if archive_filename not in self.archives:
+            self.archives[archive_filename] = archive.Archive(archive_filename)
+        return self.archives[archive_filename]
 
     def strip_tags(self, line):
-        parsed = BeautifulSoup(line)
+        """Return the text of line without markup, with entities decoded.
+        Lines without markup come straight back; the rest are remembered, since
+        the same emotes and dice rolls turn up over and over."""
+        if "<" not in line and "&" not in line and not line.isspace():
+            return line
+        stripped = self.strip_tags_cache.get(line)
+        if stripped is None:
+            stripped = self.fast_strip_tags(line)
+            if stripped is None:
+                stripped = self.soup_strip_tags(line)
+            self.strip_tags_cache.put(line, stripped)
+        return stripped
+
+    def fast_strip_tags(self, line):
+        """Strip simple inline markup in one pass, giving the same result as
+        soup_strip_tags. Returns None if the line needs the real parser."""
+        if self.soup_markup_pattern.search(line):
+            return None
+        for tag in self.tag_pattern.findall(line):
+            # a quoted ">" would have ended the tag too soon
+            if tag.count("\"") % 2 or tag.count("'") % 2:
+                return None
+
+        result = []
+        for text in self.tag_pattern.split(line):
+            if "&" in text:
+                text = self.decode_entities(text)
+                if text is None:
+                    return None
+            # as in soup, whitespace-only text between tags collapses
+            if text and not text.strip(" \t\n\r\f"):
+                text = u"\n" if "\n" in text else u" "
+            result.append(text)
+        return u"".join(result)
+
+    def decode_entities(self, text):
+        """Decode named and decimal character references; return None if text
+        has any other sort of ampersand, which soup treats idiosyncratically."""
+        def decode(match):
+            name = match.group(1)
+            if name.startswith("#"):
+                return unichr(int(name[1:]))
+            return unichr(htmlentitydefs.name2codepoint[name])
+
+        if text.count("&") != len(self.entity_pattern.findall(text)):
+            return None
+        try:
+            return self.entity_pattern.sub(decode, text)
+        except (KeyError, ValueError, OverflowError):
+            return None
+
+    def soup_strip_tags(self, line):
+        parsed = BeautifulSoup(line,
+                               convertEntities=BeautifulSoup.HTML_ENTITIES)
 
         def tag_text(parsed):
             result = []
@@ -335,6 +1575,17 @@ class HTMLExporter(LogExporter):
         self.output_file_extension = ".html"
         self.index_basename = "index.html"
 
+        # a page of corpus statistics, linked from the index; needs NumPy
+        self.stats_page = False
+        self.stats_template = "templates/html/stats_template.djt"
+        self.stats_basename = "stats.html"
+
+        # Incremental builds remember what each page was rendered from. Bump
+        # the version whenever a change would alter the HTML rendered from the
+        # same JSON; changing a template has the same effect.
+        self.version = 1
+        self.build_state_basename = ".build_state"
+
         self.line_templates = {
             "index_link": u"<li><a href=\"%s\">%s</a></li>",
             "text": u"<p>%s</p>",
@@ -343,53 +1594,161 @@ class HTMLExporter(LogExporter):
         }
 
     def output_text(self, log_entry):
-        return self.line_templates["text"] % log_entry["content"]
+        return self.line_templates["text"] % log_entry.content
 
     def output_statement(self, log_entry):
-        return self.line_templates["statement"] % (log_entry["player"],
-                                                   log_entry["content"])
+        return self.line_templates["statement"] % (log_entry.player,
+                                                   log_entry.content)
 
     def output_emote(self, log_entry):
-        return self.line_templates["emote"] % log_entry["content"]
-
-    def output_file(self, input_filename, output_filename,
-                    previous_file=None, next_file=None):
-        lines = [self.output_entry(entry) for entry
-                 in json.load(file(input_filename))]
-
-        output_file = codecs.open(output_filename, encoding="utf-8", mode="w")
+        return self.line_templates["emote"] % log_entry.content
+
+    def chapter_frame(self, input_filename, output_filename,
+                      previous_file=None, next_file=None):
+        return template.render_around(
+            self.log_template, self.page_links(previous_file, next_file),
+            "content")
+
+    def page_replacements(self, input_filename, previous_file=None,
+                          next_file=None):
+        """The log template's replacements for a chapter; content is a
+        generator, rendering each entry only as it's needed."""
+        lines = (self.output_entry(entry) for entry
+                 in self.read_entries(input_filename))
+        replacements = self.page_links(previous_file, next_file)
+        replacements["content"] = self.join_lines(lines)
+        return replacements
+
+    def page_links(self, previous_file=None, next_file=None):
         # TODO: also insert date, since there's a tag for it
-        output_lines = template.render(self.log_template, {
+        return {
             "previous": os.path.basename(previous_file) if previous_file else None,
             "next": os.path.basename(next_file) if next_file else None,
-            "content": self.line_separator.join(lines),
-        })
-        output_file.writelines(output_lines)
-        output_file.close()
+        }
 
-    def output_directory(self, input_dir, output_dir):
+    def output_directory(self, input_dir, output_dir, incremental=False,
+                         jobs=1):
+        tasks, finish = self.plan_directory(input_dir, output_dir, incremental)
+        self.export_files(tasks, jobs)
+        finish()
+
+    def plan_directory(self, input_dir, output_dir, incremental=False):
         # TODO: improve index page. Chapter titles? Can probably be manual.
         input_filenames, output_filenames = LogExporter.build_file_lists(
             self, input_dir, output_dir)
+        if incremental:
+            if self.is_archive(input_dir):
+                raise Exception("Incremental export needs a directory of "
+                                "JSON files, not an archive")
+            return self.plan_update(input_filenames, output_filenames,
+                                    output_dir)
+
+        def finish():
+            # only once every chapter is written
+            self.output_index_file(output_filenames,
+                                   os.path.join(output_dir,
+                                                self.index_basename))
+            if self.stats_page:
+                self.output_stats_file(
+                    input_dir, os.path.join(output_dir, self.stats_basename))
+
+        return ([self.build_task(input_filename, output_dict)
+                 for input_filename, output_dict
+                 in zip(input_filenames, self.links(output_filenames))],
+                finish)
+
+    def build_task(self, input_filename, output_dict):
+        """Return an export_files task for a chapter, given its links dict."""
+        return (input_filename, output_dict["current"], {
+            "previous_file": output_dict["previous"],
+            "next_file": output_dict["next"],
+        })
+
+    def plan_update(self, input_filenames, output_filenames, output_dir):
+        """Like plan_directory, but only renders chapters whose JSON or
+        previous/next links have changed since the last incremental build, and
+        the index only if the list of chapters has changed. Pages whose JSON
+        has been removed are deleted. The stats page, if any, is redone if any
+        chapter has changed."""
+        build_state = Manifest(
+            os.path.join(output_dir, self.build_state_basename),
+            "%d:%s:%s%s" % (self.version, file_hash(self.log_template),
+                            file_hash(self.index_template),
+                            self.selection_key()))
+
+        page_names = [os.path.basename(filename)
+                      for filename in output_filenames]
+        removed = 0
+        for name in build_state.names():
+            if name not in page_names:
+                removed += 1
+                print "Removing stale page: %s" % name
+                if os.path.exists(os.path.join(output_dir, name)):
+                    os.remove(os.path.join(output_dir, name))
+                build_state.remove(name)
+
+        tasks = []
+        chapter_links = []
         for input_filename, output_dict in zip(input_filenames,
                                                self.links(output_filenames)):
-            self.output_file(input_filename, output_dict["current"],
-                             previous_file=output_dict["previous"],
-                             next_file=output_dict["next"])
-
-        self.output_index_file(output_filenames,
-                               os.path.join(output_dir, self.index_basename))
+            name = os.path.basename(output_dict["current"])
+            links = {
+                "previous": output_dict["previous"] and
+                            os.path.basename(output_dict["previous"]),
+                "next": output_dict["next"] and
+                        os.path.basename(output_dict["next"]),
+            }
+            if (os.path.exists(output_dict["current"]) and
+                    build_state.is_current(name, input_filename, **links)):
+                continue
+            tasks.append(self.build_task(input_filename, output_dict))
+            chapter_links.append((name, input_filename, links))
+
+        def finish():
+            for name, input_filename, links in chapter_links:
+                build_state.record(name, input_filename, **links)
+
+            index_filename = os.path.join(output_dir, self.index_basename)
+            if (build_state.get_value("index") != page_names or
+                    build_state.get_value("stats") != self.stats_page or
+                    not os.path.exists(index_filename)):
+                self.output_index_file(output_filenames, index_filename)
+                build_state.set_value("index", page_names)
+                build_state.set_value("stats", self.stats_page)
+
+            stats_filename = os.path.join(output_dir, self.stats_basename)
+            if self.stats_page and (tasks or removed or
+                                    not os.path.exists(stats_filename)):
+                self.output_stats_file(os.path.dirname(input_filenames[0]),
+                                       stats_filename)
+            elif not self.stats_page and os.path.exists(stats_filename):
+                os.remove(stats_filename)  # left from an export with the page
+
+            build_state.save()
+            print "Rendered %d of %d chapters" % (len(tasks), len(page_names))
+
+        return (tasks, finish)
 
     def output_index_file(self, output_filenames, index_filename):
+        output_file = codecs.open(index_filename, encoding="utf-8", mode="w")
+        template.render_to(output_file, self.index_template,
+                           self.index_replacements(output_filenames))
+        output_file.close()
+
+    def index_replacements(self, output_filenames):
         link_lines = [self.build_index_link(filename)
                       for filename in output_filenames]
-
-        output_file = codecs.open(index_filename, encoding="utf-8", mode="w")
-        output_lines = template.render(self.index_template, {
+        return {
             "content": self.line_separator.join(link_lines),
-        })
-        output_file.writelines(output_lines)
-        output_file.close()
+            "stats": self.stats_basename if self.stats_page else None,
+        }
+
+    def output_stats_file(self, input_dir, stats_filename):
+        # imported here, so that NumPy is only needed for the stats page
+        import analytics
+        corpus = analytics.Corpus(input_dir, self)
+        corpus.write_page(stats_filename, self.stats_template,
+                          self.index_basename)
 
     def build_index_link(self, filename):
         """Create a link for insertion into the HTML index."""
@@ -403,14 +1762,15 @@ class HTMLExporter(LogExporter):
         'previous' will be None for the first item, and 'next' will be None for
         the last item."""
         if len(items) == 0:
-            raise "Empty list passed to links"
+            raise Exception("Empty list passed to links")
         else:
             for n in range(0, len(items)):
                 if n == 0:
                     yield {
                         "previous": None,
                         "current": items[n],
-                        "next": items[n+1]
+                        # a lone item has no next, either
+                        "next": items[n+1] if len(items) > 1 else None
                     }
                 elif n == len(items) - 1:
                     yield {
@@ -425,10 +1785,182 @@ class HTMLExporter(LogExporter):
                         "next": items[n+1]
                     }
 
+class SiteExporter(HTMLExporter):
+    """Generates HTML for publishing on a static site: long chapters are split
+    into pages of page_size entries, the CSS is in one stylesheet shared by
+    every page, and each file gets a gzipped copy (and a brotli one, if the
+    brotli module is installed) for the server to send instead."""
+    def __init__(self):
+        HTMLExporter.__init__(self)
+
+        self.index_template = "templates/site/index_template.djt"
+        self.log_template = "templates/site/log_template.djt"
+        self.stylesheet = "templates/site/style.css"
+        self.page_size = 500  # entries per page
+
+    def chapter_writer(self, input_filename, output_filename,
+                       previous_file=None, next_file=None, page_count=None):
+        """Write the chapter as pages of page_size entries: output_filename,
+        then page_filename(output_filename, 1) and so on, each linking to the
+        pages either side of it. page_count saves counting the entries, if the
+        caller already knows. Pages beyond the last, left by an earlier export
+        of a longer chapter or with a smaller page_size, are removed."""
+        chapter_title = re.sub(self.input_extension_pattern, "",
+                               os.path.basename(input_filename))
+        stylesheet_link = self.stylesheet_link()
+        if page_count is None:
+            page_count = self.page_count(self.count_entries(input_filename))
+
+        def write_page(n, lines):
+            if n > 0:
+                previous_page = self.page_filename(output_filename, n - 1)
+            else:
+                previous_page = previous_file
+            if n < page_count - 1:
+                next_page = self.page_filename(output_filename, n + 1)
+            else:
+                next_page = next_file
+
+            page = self.render_string(self.log_template, {
+                "title": chapter_title,
+                "stylesheet": stylesheet_link,
+                "previous": previous_page and os.path.basename(previous_page),
+                "next": next_page and os.path.basename(next_page),
+                "page": str(n + 1),
+                "page_count": str(page_count) if page_count > 1 else None,
+                "content": self.line_separator.join(lines),
+            })
+            self.write_compressed(self.page_filename(output_filename, n), page)
+
+        lines = []  # rendered, but not yet written
+        n = 0  # the next page
+        while True:
+            entries = yield
+            if entries is None:
+                break
+            lines.extend(self.output_entry(entry) for entry in entries)
+            while len(lines) >= self.page_size and n < page_count:
+                write_page(n, lines[:self.page_size])
+                del lines[:self.page_size]
+                n += 1
+        # the last page, if it isn't full, or an empty chapter's only page
+        while n < page_count:
+            write_page(n, lines[:self.page_size])
+            del lines[:self.page_size]
+            n += 1
+        self.remove_pages(output_filename, page_count)
+
+    def output_directory(self, input_dir, output_dir, jobs=1):
+        tasks, finish = self.plan_directory(input_dir, output_dir)
+        self.export_files(tasks, jobs)
+        finish()
+
+    def plan_directory(self, input_dir, output_dir):
+        input_filenames, output_filenames = LogExporter.build_file_lists(
+            self, input_dir, output_dir)
+        self.output_stylesheet(output_dir)
+
+        # a chapter's Previous link goes to the last page of the chapter before
+        page_counts = [self.page_count(self.count_entries(input_filename))
+                       for input_filename in input_filenames]
+        tasks = []
+        for n, (input_filename, output_dict) in enumerate(zip(
+                input_filenames, self.links(output_filenames))):
+            task = self.build_task(input_filename, output_dict)
+            task[2]["page_count"] = page_counts[n]
+            if n > 0:
+                task[2]["previous_file"] = self.page_filename(
+                    output_dict["previous"], page_counts[n - 1] - 1)
+            tasks.append(task)
+
+        return (tasks, lambda: self.output_index_file(
+            output_filenames, os.path.join(output_dir, self.index_basename)))
+
+    def output_index_file(self, output_filenames, index_filename):
+        link_lines = [self.build_index_link(filename)
+                      for filename in output_filenames]
+        self.write_compressed(index_filename, self.render_string(
+            self.index_template, {
+                "stylesheet": self.stylesheet_link(),
+                "content": self.line_separator.join(link_lines),
+            }))
+
+    def output_stylesheet(self, output_dir):
+        """Copy the stylesheet to output_dir. Pages link to it with its hash
+        appended, so it can be cached for good; a changed stylesheet gets a
+        new link."""
+        basename = os.path.basename(self.stylesheet)
+        self.write_compressed(os.path.join(output_dir, basename),
+                              file(self.stylesheet, "rb").read())
+
+    def worker_settings(self):
+        settings = HTMLExporter.worker_settings(self)
+        settings["page_size"] = self.page_size
+        return settings
+
+    def stylesheet_link(self):
+        return "%s?v=%s" % (os.path.basename(self.stylesheet),
+                            file_hash(self.stylesheet)[:10])
+
+    def page_count(self, entry_count):
+        # an empty chapter still gets a page
+        return max(1, (entry_count + self.page_size - 1) // self.page_size)
+
+    def page_filename(self, output_filename, n):
+        """The filename of the nth page (from 0) of a chapter whose first page
+        is output_filename: chapter.html, chapter.p2.html, chapter.p3.html...
+        Not chapter-2.html, which could be another chapter's name, as
+        2009-01-12-2 is."""
+        if n == 0:
+            return output_filename
+        base, extension = os.path.splitext(output_filename)
+        return "%s.p%d%s" % (base, n + 1, extension)
+
+    def remove_pages(self, output_filename, page_count):
+        """Remove any of the chapter's pages after the first page_count, and
+        their compressed copies. Only names page_filename could have given
+        are touched."""
+        output_dir, basename = os.path.split(output_filename)
+        base, extension = os.path.splitext(basename)
+        page_pattern = re.compile(r"^%s\.p([2-9]|[1-9]\d+)%s(\.gz|\.br)?$"
+                                  % (re.escape(base), re.escape(extension)))
+        for filename in os.listdir(output_dir or "."):
+            match = page_pattern.match(filename)
+            if match and int(match.group(1)) > page_count:
+                os.remove(os.path.join(output_dir, filename))
+
+    def write_compressed(self, output_filename, data):
+        """Write data to output_filename, along with .gz and, if possible, .br
+        copies. A .br copy from an export with brotli is removed if brotli is
+        missing now, since it would be out of date."""
+        for filename, compressed in self.compressed_versions(output_filename,
+                                                             data):
+            output_file = file(filename, "wb")
+            output_file.write(compressed)
+            output_file.close()
+        if brotli is None and os.path.exists(output_filename + ".br"):
+            os.remove(output_filename + ".br")
+
+    def compressed_versions(self, output_filename, data):
+        yield (output_filename, data)
+
+        buffer = StringIO()
+        # a fixed mtime, so unchanged pages compress to the same bytes
+        gzip_file = gzip.GzipFile(os.path.basename(output_filename), "wb", 9,
+                                  buffer, mtime=0)
+        gzip_file.write(data)
+        gzip_file.close()
+        yield (output_filename + ".gz", buffer.getvalue())
+
+        if brotli is not None:
+            yield (output_filename + ".br", brotli.compress(data))
+
+
 class EpubExporter(LogExporter):
     """
-    Generates Markdown files for each chapter, then exports them as an ebook
-    using Pandoc.
+    Generates an XHTML file for each chapter, then packs them into an epub
+    along with a title page and table of contents. Alternatively, generates
+    Markdown files for each chapter and exports them as an ebook using Pandoc.
     """
     def __init__(self):
         LogExporter.__init__(self)
@@ -436,6 +1968,35 @@ class EpubExporter(LogExporter):
         self.title_file = "templates/epub/title.md"
         self.output_file_extension = ".md"  # intermediate files
 
+        # for the built-in epub builder
+        self.chapter_file_extension = ".xhtml"
+        self.chapter_template = "templates/epub/chapter.xhtml.djt"
+        self.title_template = "templates/epub/title.xhtml.djt"
+        self.package_template = "templates/epub/content.opf.djt"
+        self.toc_template = "templates/epub/toc.ncx.djt"
+        self.container_file = "templates/epub/container.xml"
+        # Chapter XHTML is cached beside the book. Bump the version whenever a
+        # change would alter the XHTML generated from the same JSON.
+        self.version = 1
+        self.cache_extension = ".cache"
+        self.build_state_basename = ".build_state"
+
+        self.xhtml_line_templates = {
+            "text": u"<p>%s</p>",
+            "statement": u"<p><b>%s:</b> %s</p>",
+            "emote": u"<p>%s</p>",
+            "manifest_item": u"<item id=\"%s\" href=\"%s\" "
+                             u"media-type=\"application/xhtml+xml\"/>",
+            "itemref": u"<itemref idref=\"%s\"/>",
+            "nav_point": u"<navPoint id=\"nav-%s\" playOrder=\"%d\">"
+                         u"<navLabel><text>%s</text></navLabel>"
+                         u"<content src=\"%s\"/></navPoint>",
+            "creator": u"<dc:creator>%s</dc:creator>",
+        }
+        # simple formatting kept in the XHTML; other tags are dropped
+        self.xhtml_inline_tags = ("b", "i", "em", "strong", "u")
+        self.markup_split_pattern = re.compile(r"(</?[A-Za-z][^<>]*>)")
+
         self.line_templates = {
             "chapter": u"# %s\n\n",
             "text": u"%s\n",
@@ -446,51 +2007,261 @@ class EpubExporter(LogExporter):
     # TODO: for all of these, handle inline HTML? Or does Pandoc?
 
     def output_text(self, log_entry):
-        return self.line_templates["text"] % log_entry["content"]
+        return self.line_templates["text"] % log_entry.content
 
     def output_statement(self, log_entry):
-        return self.line_templates["statement"] % (log_entry["player"],
-                                                   log_entry["content"])
+        return self.line_templates["statement"] % (log_entry.player,
+                                                   log_entry.content)
 
     def output_emote(self, log_entry):
-        return self.line_templates["emote"] % log_entry["content"]
-
-    def output_file(self, input_filename, output_filename):
-        """Read the JSON input file and write it as Pandoc markdown."""
-
-        print "Generating markdown: %s -> %s" % (input_filename,
-                                                 output_filename)
-        lines = [self.output_entry(entry) for entry
-                 in json.load(file(input_filename))]
-
-        output_file = codecs.open(output_filename, encoding="utf-8", mode="w")
-
-        chapter_title = re.search(r"\/(.+)\.json", input_filename).group(1)
-        chapter_title = chapter_title.replace("_", " ")
-        output_file.write(self.line_templates["chapter"] % chapter_title)
-
-        output_file.write(self.line_separator.join(lines))
-        output_file.write(self.line_separator)  # trailing newline is good form
-
-        output_file.close()
+        return self.line_templates["emote"] % log_entry.content
+
+    # chapters are written as Pandoc markdown, or, if output_filename ends
+    # with .xhtml, as XHTML chapters for the epub
+
+    def chapter_frame(self, input_filename, output_filename):
+        chapter_title = self.chapter_title(input_filename)
+        if output_filename.endswith(self.chapter_file_extension):
+            return template.render_around(self.chapter_template,
+                                          {"title": escape(chapter_title)},
+                                          "content")
+        return (self.line_templates["chapter"] % chapter_title,
+                self.line_separator)  # trailing newline is good form
+
+    def entry_renderer(self, output_filename):
+        if output_filename.endswith(self.chapter_file_extension):
+            return self.xhtml_entry
+        return self.output_entry
+
+    def xhtml_entry(self, log_entry):
+        if log_entry.type_code == STATEMENT:
+            return self.xhtml_line_templates["statement"] % (
+                escape(self.strip_tags(log_entry.player)),
+                self.xhtml_content(log_entry.content))
+        return self.xhtml_line_templates[log_entry.type] % (
+            self.xhtml_content(log_entry.content))
+
+    def xhtml_content(self, content):
+        """Convert the HTML content of a log entry to well-formed XHTML: simple
+        inline formatting is kept (and closed, if the log didn't), other tags
+        are dropped, and entities are decoded and the text escaped. Anything
+        more unusual is reduced to plain text."""
+        if self.soup_markup_pattern.search(content):
+            return escape(self.strip_tags(content))
+
+        result = []
+        open_tags = []
+        for n, piece in enumerate(self.markup_split_pattern.split(content)):
+            if n % 2 == 0:  # text
+                if "&" in piece:
+                    piece = self.decode_entities(piece)
+                    if piece is None:
+                        return escape(self.strip_tags(content))
+                result.append(escape(piece))
+                continue
+
+            closing, name = re.match(r"<(/?)([A-Za-z]+)", piece).groups()
+            name = name.lower()
+            if name == "br" and not closing:
+                result.append(u"<br />")
+            elif name not in self.xhtml_inline_tags:
+                continue
+            elif not closing:
+                open_tags.append(name)
+                result.append(u"<%s>" % name)
+            elif name in open_tags:
+                while open_tags:
+                    open_name = open_tags.pop()
+                    result.append(u"</%s>" % open_name)
+                    if open_name == name:
+                        break
+
+        while open_tags:
+            result.append(u"</%s>" % open_tags.pop())
+        return u"".join(result)
+
+    def chapter_title(self, input_filename):
+        chapter_title = re.sub(self.input_extension_pattern, "",
+                               os.path.basename(input_filename))
+        return chapter_title.replace("_", " ")
+
+    def progress_message(self, input_filename, output_filename):
+        if output_filename.endswith(self.chapter_file_extension):
+            return "Generating XHTML: %s -> %s" % (input_filename,
+                                                   output_filename)
+        return "Generating markdown: %s -> %s" % (input_filename,
+                                                  output_filename)
+
+    def output_book(self, input_dir, output_path, jobs=1, pandoc=False):
+        """
+        Converts JSON files from input_dir to a single epub file at output_path,
+        or hands the job to output_pandoc_book if pandoc is True.
 
-    def output_book(self, input_dir, output_path):
+        Each chapter's XHTML is cached in a folder named after the book (e.g.
+        my_book.cache), and only generated again when its JSON changes; with
+        jobs > 1, by that many worker processes. The chapters are then streamed
+        into the epub in sorted order, with no external tools.
+        """
+        tasks, finish = self.plan_book(input_dir, output_path, pandoc)
+        self.export_files(tasks, jobs)
+        finish()
+
+    def plan_book(self, input_dir, output_path, pandoc=False):
+        """Return (tasks, finish) for output_book, as plan_directory does for
+        output_directory."""
+        if pandoc:
+            return self.plan_pandoc_book(input_dir, output_path)
+
+        cache_dir = os.path.splitext(output_path)[0] + self.cache_extension
+        chapter_filenames, tasks, finish_cache = self.plan_chapter_cache(
+            input_dir, cache_dir)
+
+        def finish():
+            finish_cache()
+            self.build_book(chapter_filenames, output_path)
+
+        return (tasks, finish)
+
+    def build_book(self, chapter_filenames, output_path):
+        """Pack the chapters' XHTML, from (input_filename, chapter_filename)
+        pairs, into an epub at output_path."""
+        print "Building %s" % output_path
+        title, authors = self.read_title_file()
+        identifier = "urn:uuid:%s" % uuid.uuid5(uuid.NAMESPACE_URL,
+                                                title.encode("utf-8"))
+        chapters = []  # (id, href, title)
+        for n, (input_filename, chapter_filename) in enumerate(
+                chapter_filenames):
+            chapters.append(("chapter-%03d" % (n + 1),
+                             "chapter-%03d.xhtml" % (n + 1),
+                             self.chapter_title(input_filename)))
+
+        temp_path = output_path + ".tmp"
+        book = zipfile.ZipFile(temp_path, "w", zipfile.ZIP_DEFLATED)
+        # the mimetype must come first, uncompressed
+        book.writestr(zipfile.ZipInfo("mimetype"), "application/epub+zip")
+        book.write(self.container_file, "META-INF/container.xml")
+        book.writestr("OEBPS/title.xhtml", self.render_string(
+            self.title_template, {
+                "title": escape(title),
+                "authors": escape(", ".join(authors)),
+            }))
+        for (chapter_id, href, chapter_title), (input_filename,
+                                                chapter_filename) in zip(
+                chapters, chapter_filenames):
+            book.write(chapter_filename, "OEBPS/" + href)
+
+        book.writestr("OEBPS/content.opf", self.render_string(
+            self.package_template, {
+                "title": escape(title),
+                "identifier": identifier,
+                "creators": self.line_separator.join(
+                    self.xhtml_line_templates["creator"] % escape(author)
+                    for author in authors),
+                "items": self.line_separator.join(
+                    self.xhtml_line_templates["manifest_item"] % (
+                        chapter_id, href)
+                    for chapter_id, href, chapter_title in chapters),
+                "itemrefs": self.line_separator.join(
+                    self.xhtml_line_templates["itemref"] % chapter_id
+                    for chapter_id, href, chapter_title in chapters),
+            }))
+        book.writestr("OEBPS/toc.ncx", self.render_string(
+            self.toc_template, {
+                "title": escape(title),
+                "identifier": identifier,
+                "nav_points": self.line_separator.join(
+                    self.xhtml_line_templates["nav_point"] % (
+                        chapter_id, n + 1, escape(chapter_title), href)
+                    for n, (chapter_id, href, chapter_title)
+                    in enumerate(chapters)),
+            }))
+        book.close()
+        os.rename(temp_path, output_path)
+
+    def plan_chapter_cache(self, input_dir, cache_dir):
+        """Plan XHTML in cache_dir for every chapter in input_dir whose JSON
+        has changed since it was last cached, and remove any whose JSON has
+        gone. Returns (input_filename, chapter_filename) pairs for every
+        chapter, in order; the export_files tasks for the stale ones; and a
+        function to call once they're done."""
+        self.prepare_directory(cache_dir)
+        build_state = Manifest(
+            os.path.join(cache_dir, self.build_state_basename),
+            "%d:%s%s" % (self.version, file_hash(self.chapter_template),
+                          self.selection_key()))
+        # an archive has no per-chapter files, so it stands in for each chapter
+        from_archive = self.is_archive(input_dir)
+
+        chapter_filenames = [
+            (input_filename,
+             os.path.join(cache_dir, re.sub(self.input_extension_pattern,
+                                            self.chapter_file_extension,
+                                            os.path.basename(input_filename))))
+            for input_filename in self.build_input_filenames(input_dir)]
+
+        names = [os.path.basename(chapter_filename)
+                 for input_filename, chapter_filename in chapter_filenames]
+        for name in build_state.names():
+            if name not in names:
+                if os.path.exists(os.path.join(cache_dir, name)):
+                    os.remove(os.path.join(cache_dir, name))
+                build_state.remove(name)
+
+        stale = [(input_filename, chapter_filename)
+                 for input_filename, chapter_filename in chapter_filenames
+                 if not (os.path.exists(chapter_filename) and
+                         build_state.is_current(
+                             os.path.basename(chapter_filename),
+                             input_dir if from_archive else input_filename))]
+        def finish():
+            for input_filename, chapter_filename in stale:
+                build_state.record(os.path.basename(chapter_filename),
+                                   input_dir if from_archive else
+                                   input_filename)
+            build_state.save()
+
+        return (chapter_filenames,
+                [(input_filename, chapter_filename, {})
+                 for input_filename, chapter_filename in stale],
+                finish)
+
+    def read_title_file(self):
+        """Return (title, [authors]) from the Pandoc title block in
+        title_file: a "% title" line, then a "% author, author" line."""
+        input_file = codecs.open(self.title_file, encoding="utf-8")
+        lines = [line[1:].strip() for line in input_file
+                 if line.startswith("%")]
+        input_file.close()
+        title = lines[0] if lines else u""
+        authors = [author.strip() for author in lines[1].split(",")
+                   if author.strip()] if len(lines) > 1 else []
+        return (title, authors)
+
+    def output_pandoc_book(self, input_dir, output_path, jobs=1):
         """
-        Converts JSON files from input_dir to a single epub file at output_path.
-        Temporarily creates a working folder named "temp" in the same location
-        as the destination output_path.
+        Converts JSON files from input_dir to a single epub file at output_path
+        using Pandoc. Temporarily creates a working folder named "temp" in the
+        same location as the destination output_path. With jobs > 1, the
+        markdown is written by that many worker processes.
         """
+        tasks, finish = self.plan_pandoc_book(input_dir, output_path)
+        self.export_files(tasks, jobs)
+        finish()
 
+    def plan_pandoc_book(self, input_dir, output_path):
         # derive temp_dir from output_path
         temp_dir = os.path.join(os.path.split(output_path)[0], "temp")
 
-        # write pandoc files to temp folder
-        LogExporter.output_directory(self, input_dir, temp_dir)
+        # pandoc files go to the temp folder
+        tasks, nothing = LogExporter.plan_directory(self, input_dir, temp_dir)
+        return (tasks, lambda: self.run_pandoc(temp_dir, output_path))
 
+    def run_pandoc(self, temp_dir, output_path):
         # invoke pandoc to generate epub at output path
         pandoc_input_files = [self.title_file]
         pandoc_input_files.extend([os.path.join(temp_dir, filename)
-                                   for filename in os.listdir(temp_dir)])
+                                   for filename in sort(os.listdir(temp_dir))])
 
         # pandoc invocation format:
         # pandoc -S --toc -o path/to/book.epub title.md input_file.md ...
@@ -510,13 +2281,89 @@ class MobiExporter(EpubExporter):
     def __init__(self):
         EpubExporter.__init__(self)
 
-    def output_book(self, input_dir, output_path):
+    def plan_book(self, input_dir, output_path, pandoc=False):
         epub_path = re.sub(r"\.mobi$", ".epub", output_path)
-        EpubExporter.output_book(self, input_dir, epub_path)
+        tasks, finish_epub = EpubExporter.plan_book(self, input_dir, epub_path,
+                                                    pandoc)
 
-        # now output_path contains foo.epub; invoke kindlegen
-        print "Building %s; this may take a few minutes." % output_path
-        subprocess.call(["kindlegen", epub_path])
+        def finish():
+            finish_epub()
+
+            # now output_path contains foo.epub; invoke kindlegen
+            print "Building %s; this may take a few minutes." % output_path
+            subprocess.call(["kindlegen", epub_path])
+
+            # remove temp epub
+            os.remove(epub_path)
 
-        # remove temp epub
-        os.remove(epub_path)
+        return (tasks, finish)
+
+
+class MultiExporter(object):
+    """Exports to several formats in one pass: each chapter is read once, and
+    its entries handed to every exporter which needs it, instead of each
+    format reading the whole corpus again.
+
+    Add each exporter with the plan from its plan_directory or plan_book;
+    run then writes every chapter, and finishes each format (indexes, books)
+    once all the chapters are done."""
+
+    def __init__(self):
+        self.plans = []  # (exporter, tasks, finish)
+
+    def add(self, exporter, plan):
+        tasks, finish = plan
+        self.plans.append((exporter, tasks, finish))
+
+    def run(self, jobs=1):
+        """With jobs > 1, chapters are written by a pool of worker processes,
+        each exporting its chapter to every format."""
+        exporters = [exporter for exporter, tasks, finish in self.plans]
+        # the exporters share what they learn about stripping tags, too
+        for exporter in exporters[1:]:
+            exporter.strip_tags_cache = exporters[0].strip_tags_cache
+
+        # each chapter's (exporter number, task) pairs, in the order the
+        # chapters are first needed
+        chapters = []
+        chapter_tasks = {}
+        for n, (exporter, tasks, finish) in enumerate(self.plans):
+            for task in tasks:
+                if task[0] not in chapter_tasks:
+                    chapter_tasks[task[0]] = []
+                    chapters.append((task[0], chapter_tasks[task[0]]))
+                chapter_tasks[task[0]].append((n, task))
+
+        pool = None
+        if jobs > 1 and len(chapters) > 1:
+            pool = multiprocessing.Pool(
+                jobs, _init_multi_export_worker,
+                ([(exporter.__class__, exporter.worker_settings())
+                  for exporter in exporters],))
+            results = pool.imap(_export_chapter_worker, chapters)
+        else:
+            results = (export_chapter(exporters, input_filename, tasks)
+                       for input_filename, tasks in chapters)
+
+        failures = 0
+        task_count = 0
+        for (input_filename, tasks), errors in itertools.izip(chapters,
+                                                              results):
+            for (n, (task_input_filename, output_filename, options)), error in (
+                    zip(tasks, errors)):
+                print exporters[n].progress_message(task_input_filename,
+                                                    output_filename)
+                if error is not None:
+                    print "  Failed: %s" % error
+                    failures += 1
+                task_count += 1
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if failures:
+            raise Exception("%d of %d files failed to export"
+                            % (failures, task_count))
+
+        for exporter, tasks, finish in self.plans:
+            finish()
@@ -0,0 +1,101 @@
+# One line of a log, as the importer produces it and the exporters consume it:
+# a type code (TEXT, STATEMENT or EMOTE), the content as HTML, and for
+# statements, the player. JSON is only how entries are stored; to_dict and
+# from_dict convert to and from the dicts that are written and read.
+#
+# Entries have __slots__ and share one copy of each player name, since whole
+# chapters of them are sometimes held in memory. For code written against the
+# old dicts, entry["type"], entry["content"], entry.get("player") and so on
+# still work, but attribute access is faster.
+
+TEXT, STATEMENT, EMOTE = range(3)
+entry_types = ("text", "statement", "emote")  # names, indexed by type code
+type_codes = dict((name, code) for code, name in enumerate(entry_types))
+
+_player_names = {}  # unicode names; str names go through intern()
+_new_entry = object.__new__
+
+
+def intern_player(player):
+    """Return the one copy of the player name which every entry with it
+    shares."""
+    if isinstance(player, str):
+        return intern(player)
+    return _player_names.setdefault(player, player)
+
+
+class LogEntry(object):
+    __slots__ = ("type_code", "content", "player")
+
+    def __init__(self, type_code, content, player=None):
+        self.type_code = type_code
+        self.content = content
+        if player is not None:
+            player = intern_player(player)
+        self.player = player
+
+    @property
+    def type(self):
+        return entry_types[self.type_code]
+
+    def to_dict(self):
+        """The entry as it's written as JSON; the dict the importer used to
+        build, so the JSON is just as it was."""
+        if self.player is None:
+            return {"type": entry_types[self.type_code],
+                    "content": self.content}
+        return {"type": entry_types[self.type_code], "player": self.player,
+                "content": self.content}
+
+    # dict-style access
+
+    def __getitem__(self, key):
+        if key == "type":
+            return entry_types[self.type_code]
+        elif key == "content":
+            return self.content
+        elif key == "player" and self.player is not None:
+            return self.player
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __reduce__(self):
+        # for pickling to and from worker processes
+        return (LogEntry, (self.type_code, self.content, self.player))
+
+    def __eq__(self, other):
+        return (isinstance(other, LogEntry) and
+                self.type_code == other.type_code and
+                self.content == other.content and self.player == other.player)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "LogEntry(%r)" % self.to_dict()
+
+
+def from_dict(entry):
+    """Make a LogEntry from a dict read from JSON. This runs once for every
+    entry read, so it fills in the slots itself rather than calling
+    __init__."""
+    log_entry = _new_entry(LogEntry)
+    try:
+        log_entry.type_code = type_codes[entry["type"]]
+    except KeyError:
+        raise Exception("Unknown entry type %s" % entry["type"])
+    log_entry.content = entry["content"]
+    player = entry.get("player")
+    if player is not None:
+        # always unicode, from JSON
+        player = _player_names.setdefault(player, player)
+    log_entry.player = player
+    return log_entry
@@ -0,0 +1,216 @@
+# Follows OpenRPG logs while a session is still being written, appending each
+# new line's entry to the chapter's JSON as it arrives, rather than importing
+# and exporting everything again.
+#
+# Output is JSON Lines, which can be appended to. How far each log has been
+# read is kept in json_dir/.watch_state, so a restarted watcher carries on
+# where it left off.
+#
+# A log which import.py has already imported isn't parsed again: the watcher
+# carries on from the end of what was imported, turning a plain JSON file into
+# the .jsonl on first sight. It then marks the log as watched in the import
+# manifest, so that import.py brings the .jsonl up to date rather than writing
+# the chapter a second time.
+import os
+import re
+import json
+import time
+import hashlib
+from manifest import Manifest
+from entry_index import index_filename
+from log_conversion import LogImporter, HTMLExporter, read_json_entries
+
+VERSION = 2
+
+
+class LogWatcher(object):
+    def __init__(self, input_dir, json_dir, html_dir=None):
+        self.input_dir = input_dir
+        self.json_dir = json_dir
+        self.html_dir = html_dir
+        self.importer = LogImporter()
+        self.importer.output_extension = ".jsonl"
+        self.exporter = HTMLExporter()
+        self.poll_interval = 2  # seconds
+
+        if not os.path.exists(json_dir):
+            os.makedirs(json_dir)
+        # for each log, by filename: the byte offset of the first unread line,
+        # a hash of the log's first few bytes, to tell if it's replaced, and
+        # the size of its output, to tell if import.py has rewritten that
+        self.head_size = 1024
+        self.state = Manifest(os.path.join(json_dir, ".watch_state"),
+                              VERSION)
+
+    def watch(self):
+        """Poll forever (or until interrupted), updating the HTML whenever any
+        log has grown."""
+        print "Watching %s; press Ctrl-C to stop" % self.input_dir
+        try:
+            while True:
+                self.update()
+                time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            print "Stopped watching"
+
+    def update(self):
+        """Read whatever has been added to each log since the last update, and
+        re-render the HTML of the chapters which changed. Returns the names of
+        the changed chapters' JSON files."""
+        changed = []
+        for input_filename, output_filename in (
+                self.importer.build_filename_pairs(self.input_dir,
+                                                   self.json_dir)):
+            if (self.importer.is_text_log(input_filename) or
+                    self.importer.is_campfire_log(input_filename)):
+                continue  # only OpenRPG logs grow a line at a time
+            if self.tail(input_filename, output_filename):
+                changed.append(os.path.basename(output_filename))
+        self.state.save()
+
+        if changed and self.html_dir is not None:
+            # renders only the chapters whose JSON has changed, and the index
+            # only if there's a new chapter
+            self.exporter.output_directory(self.json_dir, self.html_dir,
+                                           incremental=True)
+        return changed
+
+    def tail(self, input_filename, output_filename):
+        """Append entries for the complete lines added to input_filename since
+        it was last read. If the log has never been read, or has been
+        replaced (it's shorter, or starts differently), or its output has been
+        rewritten, the watcher starts again from what import.py imported, or
+        failing that from the start of the log. Returns the number of entries
+        appended."""
+        name = os.path.basename(input_filename)
+        state = self.state.get_value(name)
+        size = os.path.getsize(input_filename)
+        if (state is not None and state["offset"] == size and
+                self.output_size(output_filename) == state["output_size"]):
+            return 0
+
+        input_file = file(input_filename, "rb")
+        taken_over = False
+        if (state is not None and state["offset"] <= size and
+                self.output_size(output_filename) == state["output_size"] and
+                self.head_hash(input_file, state["offset"]) == state["head"]):
+            offset = state["offset"]
+        else:
+            taken_over = True
+            offset = self.adopt_output(input_file, input_filename,
+                                       output_filename)
+            if offset is None:
+                offset = 0
+                self.start_output(output_filename)
+        input_file.seek(offset)
+        data = input_file.read(size - offset)
+        # a line still being written is left for next time
+        complete = data.rfind("\n") + 1
+
+        count = 0
+        output_file = file(output_filename, "a")
+        # the last item of the split is the empty string after the final "\n"
+        for line in data[:complete].split("\n")[:-1]:
+            entry = self.importer.process_openRPG_line(line)
+            if entry is not None:  # skip lines which matched nothing
+                output_file.write(json.dumps(entry.to_dict()))
+                output_file.write("\n")
+                count += 1
+        output_file.close()
+
+        self.state.set_value(name, {
+            "offset": offset + complete,
+            "head": self.head_hash(input_file, offset + complete),
+            "output_size": self.output_size(output_filename),
+        })
+        input_file.close()
+        if taken_over:
+            self.mark_watched(input_filename, output_filename,
+                              size - offset - complete)
+        if count:
+            print "Appended %d entries: %s -> %s" % (count, input_filename,
+                                                     output_filename)
+        return count
+
+    def adopt_output(self, input_file, input_filename, output_filename):
+        """If import.py has imported input_filename, and the log has only grown
+        since, return the offset of the first line it didn't import, having
+        turned its output into output_filename if need be. Otherwise return
+        None."""
+        record = self.import_manifest().get(os.path.basename(input_filename))
+        if record is None:
+            return None
+        imported_filename = os.path.join(self.json_dir, record["output"])
+        offset = record["size"]
+        if (not os.path.exists(imported_filename) or
+                offset > os.path.getsize(input_filename) or
+                self.prefix_hash(input_file, offset) != record["hash"]):
+            return None
+        if offset > 0:
+            # the importer reads a final line without its "\n"; that one is
+            # parsed again once it's finished
+            input_file.seek(offset - 1)
+            if input_file.read(1) != "\n":
+                return None
+
+        if imported_filename != output_filename:
+            # plain JSON can't be appended to; copy the entries as they are
+            self.importer.write_json(read_json_entries(imported_filename),
+                                     output_filename)
+            for filename in (imported_filename,
+                             index_filename(imported_filename)):
+                if os.path.exists(filename):
+                    os.remove(filename)
+        print "Following %s from %s" % (input_filename, record["output"])
+        return offset
+
+    def mark_watched(self, input_filename, output_filename, unread):
+        """Record output_filename in the import manifest as input_filename's
+        output, so import.py updates it instead of writing the chapter again.
+        It's current, as import.py sees it, only if no line is left unread."""
+        manifest = self.import_manifest()
+        manifest.record(os.path.basename(input_filename), input_filename,
+                        output=os.path.basename(output_filename),
+                        watched=True, unread=unread)
+        manifest.save()
+
+    def import_manifest(self):
+        return Manifest(os.path.join(self.json_dir,
+                                     self.importer.manifest_basename),
+                        self.importer.version)
+
+    def output_size(self, output_filename):
+        if not os.path.exists(output_filename):
+            return None
+        return os.path.getsize(output_filename)
+
+    def prefix_hash(self, input_file, size):
+        """Hash the first size bytes of input_file, as Manifest hashes a whole
+        file."""
+        digest = hashlib.sha1()
+        input_file.seek(0)
+        while size > 0:
+            block = input_file.read(min(size, 65536))
+            if not block:
+                break
+            digest.update(block)
+            size -= len(block)
+        return digest.hexdigest()
+
+    def head_hash(self, input_file, offset):
+        """Hash the part of the first head_size bytes of input_file which
+        had been read by offset."""
+        input_file.seek(0)
+        return hashlib.sha1(input_file.read(min(offset,
+                                                self.head_size))).hexdigest()
+
+    def start_output(self, output_filename):
+        """Empty output_filename, and remove any plain JSON version of it, so
+        the chapter isn't listed twice. Entry indexes are removed too, since
+        the watcher doesn't keep them up to date."""
+        file(output_filename, "w").close()
+        json_filename = re.sub(r"\.jsonl$", ".json", output_filename)
+        for filename in (json_filename, index_filename(json_filename),
+                         index_filename(output_filename)):
+            if os.path.exists(filename):
+                os.remove(filename)
@@ -0,0 +1,45 @@
+# A small least-recently-used cache, since this Python has no
+# functools.lru_cache.
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Maps keys to values, holding at most max_size entries; adding one more
+    evicts whichever was used least recently. If size_of is given, max_size is
+    instead the most that size_of(value) may total across the cache, e.g. in
+    bytes; a value bigger than that on its own isn't kept at all."""
+
+    def __init__(self, max_size, size_of=None):
+        self.max_size = max_size
+        self.size_of = size_of
+        self.size = 0
+        self.entries = OrderedDict()  # least recently used first
+
+    def get(self, key, default=None):
+        """Return the value for key, marking it as just used, or default."""
+        if key not in self.entries:
+            return default
+        value = self.entries.pop(key)
+        self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self.remove(key)
+        size = self.size_of(value) if self.size_of else 1
+        if size > self.max_size:
+            return
+        while self.entries and self.size + size > self.max_size:
+            self.remove(next(iter(self.entries)))
+        self.entries[key] = value
+        self.size += size
+
+    def remove(self, key):
+        if key in self.entries:
+            value = self.entries.pop(key)
+            self.size -= self.size_of(value) if self.size_of else 1
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
@@ -0,0 +1,106 @@
+# Keeps a record of the source files a build step has already processed, so
+# that the next run can skip any whose contents haven't changed.
+import os
+import json
+import hashlib
+
+
+def file_hash(filename):
+    """Return the SHA-1 hex digest of the contents of filename."""
+    digest = hashlib.sha1()
+    input_file = file(filename, "rb")
+    for block in iter(lambda: input_file.read(65536), ""):
+        digest.update(block)
+    input_file.close()
+    return digest.hexdigest()
+
+
+class Manifest(object):
+    """A JSON file mapping names to records of the source files they were built
+    from. Each record holds the source's size, mtime and content hash, plus any
+    extra values the caller wants to check or remember; other values, not tied
+    to a source file, can be kept with set_value. If the manifest on disk was
+    written by a different version of the caller, it is ignored, so everything
+    counts as out of date."""
+
+    def __init__(self, filename, version):
+        self.filename = filename
+        self.version = version
+        self.records = {}
+        self.values = {}
+        self.changed = False  # only save if something changed
+
+        if os.path.exists(filename):
+            data = json.load(file(filename))
+            if data.get("version") == version:
+                self.records = data["records"]
+                self.values = data.get("values", {})
+
+    def is_current(self, name, source_filename, **extra):
+        """True if name was recorded from source_filename's current contents,
+        and with the same extra values."""
+        record = self.records.get(name)
+        if record is None:
+            return False
+        for key, value in extra.items():
+            if record.get(key) != value:
+                return False
+
+        stat = os.stat(source_filename)
+        if record["size"] != stat.st_size:
+            return False
+        if record["mtime"] == stat.st_mtime:
+            return True
+        # touched, but possibly not changed; only now is hashing worth it
+        if record["hash"] == file_hash(source_filename):
+            record["mtime"] = stat.st_mtime
+            self.changed = True
+            return True
+        return False
+
+    def record(self, name, source_filename, **extra):
+        """Remember source_filename's current state under name."""
+        stat = os.stat(source_filename)
+        record = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "hash": file_hash(source_filename),
+        }
+        record.update(extra)
+        self.records[name] = record
+        self.changed = True
+
+    def get(self, name):
+        return self.records.get(name)
+
+    def remove(self, name):
+        if name in self.records:
+            del self.records[name]
+            self.changed = True
+
+    def names(self):
+        return self.records.keys()
+
+    def get_value(self, key):
+        return self.values.get(key)
+
+    def set_value(self, key, value):
+        if self.values.get(key) != value:
+            self.values[key] = value
+            self.changed = True
+
+    def save(self):
+        """Write the manifest, if anything has changed. Goes via a temporary
+        file, so an interrupted run can't leave a truncated manifest behind."""
+        if not self.changed and os.path.exists(self.filename):
+            return
+        temp_filename = self.filename + ".tmp"
+        output_file = file(temp_filename, "w")
+        json.dump({
+            "version": self.version,
+            "records": self.records,
+            "values": self.values,
+        }, output_file, indent=1, sort_keys=True)
+        output_file.close()
+        os.rename(temp_filename, self.filename)
+        self.changed = False
@@ -0,0 +1,199 @@
+# Finds chapters which overlap because more than one of us logged the same
+# session, and writes a copy of the JSON without the repeats.
+#
+# Each entry is reduced to a hash of its type, player and text (without markup,
+# case or extra whitespace, which differ between clients), and each run of
+# shingle_size entries to a hash of those: a shingle. One pass over the chapters
+# in order looks up each shingle in a dict of those seen so far, so only
+# chapters which share some shingle are ever compared, and the work grows with
+# the number of entries, not the number of pairs of chapters. Shared shingles
+# close to one another are joined into spans; spans shorter than min_span
+# entries are ignored.
+#
+# A chapter which is almost all (containment) covered by one longer chapter is
+# dropped. From what's left, entries covered by an earlier chapter are trimmed
+# from the later one, so that a session logged by two people is exported once,
+# in the order of the chapters.
+import os
+import json
+from log_conversion import LogImporter, LogExporter
+
+
+class Overlap(object):
+    """Entries first to last of chapter, which repeat entries other_first to
+    other_last of other_chapter (all counting from 0)."""
+
+    def __init__(self, chapter, first, last, other_chapter, other_first,
+                 other_last):
+        self.chapter = chapter
+        self.first = first
+        self.last = last
+        self.other_chapter = other_chapter
+        self.other_first = other_first
+        self.other_last = other_last
+
+    def __len__(self):
+        return self.last - self.first + 1
+
+    def other_length(self):
+        return self.other_last - self.other_first + 1
+
+
+class OverlapFinder(object):
+    def __init__(self):
+        self.exporter = LogExporter()
+        self.shingle_size = 4  # entries
+        self.min_span = 10  # entries
+        # shared shingles at most this many entries apart are one span
+        self.max_gap = 2
+        self.containment = 0.9
+        # shingles seen more often than this, e.g. a stock greeting, are too
+        # common to say anything and are no longer looked up
+        self.max_occurrences = 50
+
+        self.chapters = []
+        self.lengths = {}
+        self.overlaps = []
+
+    def entry_hash(self, entry):
+        text = self.exporter.strip_tags(entry.content)
+        return hash((entry.type_code, (entry.player or u"").lower(),
+                     u" ".join(text.lower().split())))
+
+    def find(self, json_dir):
+        """Find every overlap between the chapters in json_dir, a directory
+        of JSON files or an archive. Returns the list of Overlaps, each with
+        the earlier chapter as other_chapter."""
+        self.chapters = self.exporter.list_chapters(json_dir)
+        self.lengths = {}
+        self.overlaps = []
+        seen = {}  # shingle -> [(chapter, position), ...]
+
+        for chapter in self.chapters:
+            hashes = [self.entry_hash(entry) for entry in
+                      self.exporter.read_entries(os.path.join(json_dir,
+                                                              chapter))]
+            self.lengths[chapter] = len(hashes)
+            shingles = [hash(tuple(hashes[n:n + self.shingle_size]))
+                        for n in xrange(len(hashes) - self.shingle_size + 1)]
+
+            # where in each earlier chapter each of this one's shingles was
+            matches = {}
+            for position, shingle in enumerate(shingles):
+                for other_chapter, other_position in seen.get(shingle, ()):
+                    matches.setdefault(other_chapter, []).append(
+                        (position, other_position))
+            for other_chapter in sorted(matches):
+                self.overlaps.extend(self.join_matches(
+                    chapter, other_chapter, matches[other_chapter]))
+
+            for position, shingle in enumerate(shingles):
+                occurrences = seen.setdefault(shingle, [])
+                if len(occurrences) < self.max_occurrences:
+                    occurrences.append((chapter, position))
+        return self.overlaps
+
+    def join_matches(self, chapter, other_chapter, matches):
+        """Join (position, other_position) shingle matches into Overlaps of at
+        least min_span entries."""
+        overlaps = []
+        span = None
+        for position, other_position in sorted(matches):
+            last = position + self.shingle_size - 1
+            other_last = other_position + self.shingle_size - 1
+            if span is not None and position <= span.last + self.max_gap + 1:
+                span.last = max(span.last, last)
+                span.other_first = min(span.other_first, other_position)
+                span.other_last = max(span.other_last, other_last)
+            else:
+                span = Overlap(chapter, position, last, other_chapter,
+                               other_position, other_last)
+                overlaps.append(span)
+        return [overlap for overlap in overlaps
+                if len(overlap) >= self.min_span]
+
+    def plan(self):
+        """Decide what to do with each chapter, from the overlaps found. Returns
+        a dict of chapter -> ("keep", None), ("drop", the chapter which
+        contains it), or ("trim", set of positions to remove)."""
+        covered = {}  # (chapter, other chapter) -> entries of chapter covered
+        for overlap in self.overlaps:
+            for key, count in (
+                    ((overlap.chapter, overlap.other_chapter), len(overlap)),
+                    ((overlap.other_chapter, overlap.chapter),
+                     overlap.other_length())):
+                covered[key] = covered.get(key, 0) + count
+
+        # a chapter contained in a longer one (or an identical earlier one)
+        actions = {}
+        for (chapter, other_chapter), count in sorted(covered.iteritems()):
+            length = self.lengths[chapter]
+            other_length = self.lengths[other_chapter]
+            if (count >= self.containment * length and
+                    (other_length > length or
+                     (other_length == length and other_chapter < chapter)) and
+                    chapter not in actions and other_chapter not in actions):
+                actions[chapter] = ("drop", other_chapter)
+
+        for overlap in self.overlaps:
+            if (overlap.chapter in actions and
+                    actions[overlap.chapter][0] == "drop" or
+                    overlap.other_chapter in actions and
+                    actions[overlap.other_chapter][0] == "drop"):
+                continue
+            positions = actions.setdefault(overlap.chapter, ("trim", set()))[1]
+            positions.update(xrange(overlap.first, overlap.last + 1))
+
+        for chapter in self.chapters:
+            actions.setdefault(chapter, ("keep", None))
+        return actions
+
+    def report(self, actions):
+        """What plan decided, as a JSON-friendly dict."""
+        chapters = []
+        for chapter in self.chapters:
+            action, detail = actions[chapter]
+            chapters.append({
+                "chapter": chapter,
+                "entries": self.lengths[chapter],
+                "action": action,
+                "contained_in": detail if action == "drop" else None,
+                "trimmed": len(detail) if action == "trim" else 0,
+                "overlaps": [{
+                    "other_chapter": overlap.other_chapter,
+                    "entries": [overlap.first + 1, overlap.last + 1],
+                    "other_entries": [overlap.other_first + 1,
+                                      overlap.other_last + 1],
+                } for overlap in self.overlaps if overlap.chapter == chapter],
+            })
+        return {
+            "chapters": chapters,
+            "dropped": len([chapter for chapter in chapters
+                            if chapter["action"] == "drop"]),
+            "trimmed_entries": sum(chapter["trimmed"] for chapter in chapters),
+        }
+
+    def write(self, json_dir, output_dir, actions):
+        """Write every chapter which isn't dropped to output_dir, without its
+        trimmed entries."""
+        if os.path.abspath(json_dir) == os.path.abspath(output_dir):
+            raise Exception("Write the deduplicated chapters somewhere other "
+                            "than %s" % json_dir)
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        importer = LogImporter()
+        for chapter in self.chapters:
+            action, detail = actions[chapter]
+            if action == "drop":
+                continue
+            entries = self.exporter.read_entries(os.path.join(json_dir,
+                                                              chapter))
+            if action == "trim":
+                entries = (entry for position, entry in enumerate(entries)
+                           if position not in detail)
+            importer.write_json(entries, os.path.join(output_dir, chapter))
+
+    def save_report(self, actions, filename):
+        output_file = file(filename, "w")
+        json.dump(self.report(actions), output_file, indent=1, sort_keys=True)
+        output_file.close()
@@ -0,0 +1,53 @@
+# Command-line program which searches the imported logs through an index built
+# by import.py --index, or by search.py --update.
+import sys
+from search_index import SearchIndex
+from clint import args
+
+usage = """
+Prints every log entry containing all of the given words, with the chapter it
+came from and its position in the chapter.
+
+Flags:
+
+-p player [optional] Only entries by this player.
+
+-t type [optional] Only entries of this type: "text", "statement", or "emote".
+
+-n count [optional] Print at most this many results. Defaults to 50.
+
+--update json_dir Instead of searching, bring the index up to date with the JSON
+files in json_dir. Only new and changed chapters are indexed.
+
+Usage: python search.py index_dir word [word ...] [-p player] [-t type]
+       python search.py index_dir --update json_dir
+"""
+
+groups = dict(args.grouped)
+positional = groups["_"].all
+
+if args.get(0) is "--help" or len(positional) < 1:
+    print usage
+    sys.exit()
+
+index = SearchIndex(positional[0])
+
+if groups.has_key("--update"):
+    index.update(groups["--update"][0])
+elif len(positional) < 2:
+    print usage
+else:
+    player = groups["-p"][0] if groups.has_key("-p") else None
+    entry_type = groups["-t"][0] if groups.has_key("-t") else None
+    limit = int(groups["-n"][0]) if groups.has_key("-n") else 50
+
+    results = index.search(" ".join(positional[1:]), player=player,
+                           entry_type=entry_type)
+    for chapter, position, entry in index.entries(results[:limit]):
+        text = index.exporter.output_entry(entry)
+        print (u"%s #%d: %s" % (chapter, position, text)).encode("utf-8")
+
+    if len(results) > limit:
+        print "(%d results; showing the first %d)" % (len(results), limit)
+    else:
+        print "(%d results)" % len(results)
@@ -0,0 +1,248 @@
+# An on-disk inverted index over the imported JSON, so that finding which
+# session a line came from doesn't mean reading every session.
+#
+# The index directory holds, for each chapter NAME:
+#
+#   NAME.terms      a line for each term in the chapter, sorted by term:
+#                   "term<tab>offset<tab>length", UTF-8, giving where its
+#                   postings are in NAME.postings
+#   NAME.postings   the entry positions each term is in: "position,..."
+#   NAME.meta       type code and player of each entry in the chapter, for
+#                   filtering results
+#
+# plus .index_manifest, recording the JSON file each chapter was indexed from.
+#
+# A query looks each of its terms up in each chapter's terms by binary search,
+# and reads only those terms' postings, plus the meta files of the chapters it
+# hits. Updating after an import rewrites only the files of the
+# chapters which changed.
+import os
+import re
+import json
+import itertools
+from manifest import Manifest
+from log_entry import type_codes
+import log_conversion
+
+VERSION = 2
+word_pattern = re.compile(r"\w+", re.U)
+
+
+def terms(text):
+    """Split plain text into lowercase search terms."""
+    return word_pattern.findall(text.lower())
+
+
+def find_term(terms_file, size, term):
+    """Return the (offset, length) of term's postings, from an open terms file
+    of the given size, or None if it isn't there. term is UTF-8."""
+    key = term + "\t"
+    # find the first line not before term's: lo is the lowest offset whose
+    # following line (the one starting at or after it) is not before it
+    lo, hi = 0, size
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if mid > 0:
+            terms_file.seek(mid - 1)
+            terms_file.readline()
+        else:
+            terms_file.seek(0)
+        line = terms_file.readline()
+        if not line or line.split("\t", 1)[0] + "\t" >= key:
+            hi = mid
+        else:
+            lo = mid + 1
+    if lo > 0:
+        terms_file.seek(lo - 1)
+        terms_file.readline()
+    else:
+        terms_file.seek(0)
+    line = terms_file.readline()
+    if not line.startswith(key):
+        return None
+    offset, length = line[len(key):].split("\t")
+    return int(offset), int(length)
+
+
+class SearchIndex(object):
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self.exporter = log_conversion.LogExporter()  # for reading and strip_tags
+
+        if not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+        self.manifest = Manifest(os.path.join(index_dir, ".index_manifest"),
+                                 VERSION)
+
+    def terms_filename(self, chapter):
+        return os.path.join(self.index_dir, chapter + ".terms")
+
+    def postings_filename(self, chapter):
+        return os.path.join(self.index_dir, chapter + ".postings")
+
+    def meta_filename(self, chapter):
+        return os.path.join(self.index_dir, chapter + ".meta")
+
+    # indexing
+
+    def update(self, json_dir):
+        """Bring the index up to date with the JSON files in json_dir: index
+        new and changed chapters, and drop chapters which have gone."""
+        chapters = self.exporter.list_chapters(json_dir)
+        removed = [chapter for chapter in self.manifest.names()
+                   if chapter not in chapters]
+        stale = [chapter for chapter in chapters
+                 if not self.manifest.is_current(
+                     chapter, os.path.join(json_dir, chapter))]
+
+        for chapter in removed:
+            for filename in (self.terms_filename(chapter),
+                             self.postings_filename(chapter),
+                             self.meta_filename(chapter)):
+                if os.path.exists(filename):
+                    os.remove(filename)
+            self.manifest.remove(chapter)
+        # shards from before the index was kept by chapter
+        for name in os.listdir(self.index_dir):
+            if re.match(r"terms-\d+\.json$", name):
+                os.remove(os.path.join(self.index_dir, name))
+        for chapter in stale:
+            print "Indexing chapter: %s" % chapter
+            filename = os.path.join(json_dir, chapter)
+            self.index_chapter(chapter, filename)
+            self.manifest.record(chapter, filename)
+
+        self.manifest.set_value("json_dir", os.path.abspath(json_dir))
+        self.manifest.save()
+        print "Indexed %d chapters, removed %d; %d unchanged" % (
+            len(stale), len(removed), len(chapters) - len(stale))
+
+    def index_chapter(self, chapter, filename):
+        """Write chapter's terms, postings and meta files."""
+        postings = {}
+        types = []
+        player_ids = []
+        players = []
+        for position, entry in enumerate(self.exporter.read_entries(filename)):
+            types.append(entry.type_code)
+            player = entry.player
+            if player is None:
+                player_ids.append(-1)
+            else:
+                if player not in players:
+                    players.append(player)
+                player_ids.append(players.index(player))
+
+            text = self.exporter.strip_tags(entry.content)
+            for term in set(terms(text)):
+                postings.setdefault(term, []).append(position)
+
+        output_file = file(self.meta_filename(chapter), "w")
+        json.dump({"types": types, "players": players,
+                   "player_ids": player_ids}, output_file,
+                  separators=(",", ":"))
+        output_file.close()
+
+        # sorted by the bytes written, which is the order find_term needs
+        terms_filename = self.terms_filename(chapter)
+        postings_filename = self.postings_filename(chapter)
+        terms_file = file(terms_filename + ".tmp", "wb")
+        postings_file = file(postings_filename + ".tmp", "wb")
+        offset = 0
+        for key, term in sorted((term.encode("utf-8"), term)
+                                for term in postings):
+            positions = postings.pop(term)
+            length = 0
+            # a common term can be in most entries; don't build all its text
+            for n in xrange(0, len(positions), 4096):
+                text = ",".join(map(str, positions[n:n + 4096]))
+                if n > 0:
+                    text = "," + text
+                postings_file.write(text)
+                length += len(text)
+            terms_file.write("%s\t%d\t%d\n" % (key, offset, length))
+            offset += length
+        terms_file.close()
+        postings_file.close()
+        os.rename(postings_filename + ".tmp", postings_filename)
+        os.rename(terms_filename + ".tmp", terms_filename)
+
+    # searching
+
+    def search(self, query, player=None, entry_type=None):
+        """Return (chapter, position) pairs for every entry containing all the
+        terms in query, in chapter order, optionally only those by player
+        (case-insensitive) or of entry_type."""
+        query_terms = sorted(set(terms(query)))
+        if not query_terms:
+            return []
+
+        query_terms = [term.encode("utf-8") for term in query_terms]
+
+        results = []
+        for chapter in log_conversion.sort(self.manifest.names()):
+            terms_filename = self.terms_filename(chapter)
+            if not os.path.exists(terms_filename):
+                continue
+            size = os.path.getsize(terms_filename)
+            terms_file = file(terms_filename, "rb")
+            postings_file = file(self.postings_filename(chapter), "rb")
+            matches = None
+            for term in query_terms:
+                found = find_term(terms_file, size, term)
+                if found is None:
+                    matches = set()
+                    break
+                offset, length = found
+                postings_file.seek(offset)
+                positions = map(int, postings_file.read(length).split(","))
+                if matches is None:
+                    matches = set(positions)
+                else:
+                    matches.intersection_update(positions)
+                if not matches:
+                    break
+            terms_file.close()
+            postings_file.close()
+
+            positions = sorted(matches)
+            if positions and (player is not None or entry_type is not None):
+                positions = self.filter_positions(chapter, positions, player,
+                                                  entry_type)
+            results.extend((chapter, position) for position in positions)
+        return results
+
+    def filter_positions(self, chapter, positions, player, entry_type):
+        meta = json.load(file(self.meta_filename(chapter)))
+        if entry_type is not None:
+            type_code = type_codes[entry_type]
+            positions = [position for position in positions
+                         if meta["types"][position] == type_code]
+        if player is not None:
+            player_ids = [n for n, name in enumerate(meta["players"])
+                          if name.lower() == player.lower()]
+            positions = [position for position in positions
+                         if meta["player_ids"][position] in player_ids]
+        return positions
+
+    def entries(self, results):
+        """Generate (chapter, position, entry) for search results. Only the
+        matching entries are read, through the chapter's entry index, if it
+        has a current one; otherwise the chapter is read up to the last."""
+        json_dir = self.manifest.get_value("json_dir")
+        for chapter, chapter_results in itertools.groupby(
+                results, lambda result: result[0]):
+            positions = [position for chapter, position in chapter_results]
+            filename = os.path.join(json_dir, chapter)
+            index = self.exporter.open_entry_index(filename)
+            if index is not None:
+                chapter_entries = index.entries(filename, positions)
+            else:
+                wanted = set(positions)
+                chapter_entries = (
+                    entry for position, entry in itertools.islice(
+                        enumerate(self.exporter.read_entries(filename)),
+                        positions[-1] + 1)
+                    if position in wanted)
+            for position, entry in itertools.izip(positions, chapter_entries):
+                yield (chapter, position, entry)
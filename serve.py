@@ -0,0 +1,45 @@
+# Command-line program which serves the imported logs as HTML, rendering each
+# chapter as it's asked for.
+import sys
+from chapter_server import ChapterServer
+from clint import args
+
+usage = """
+Serves the chapters in json_dir, a directory of JSON files or an archive written
+by import.py --archive, as the HTML export.py -f html would write, without
+writing any of it. Each chapter is rendered the first time it's asked for, and
+kept until its JSON changes; chapters imported while the server runs are
+listed straight away.
+
+Flags:
+
+-p port [optional] Port to listen on. Defaults to 8000.
+
+-a address [optional] Address to listen on. Defaults to 127.0.0.1, which only
+this machine can reach; 0.0.0.0 for everywhere.
+
+--cache MB [optional] Most rendered pages to keep in memory, in megabytes.
+Defaults to 32.
+
+Usage: python serve.py json_dir [-p port] [-a address] [--cache MB]
+"""
+
+groups = dict(args.grouped)
+positional = groups["_"].all if groups.has_key("_") else []
+
+if args.get(0) is "--help" or len(positional) != 1:
+    print usage
+    sys.exit()
+
+address = (groups["-a"][0] if groups.has_key("-a") else "127.0.0.1",
+           int(groups["-p"][0]) if groups.has_key("-p") else 8000)
+cache_size = int(float(groups["--cache"][0]) * 1024 * 1024
+                 if groups.has_key("--cache") else 32 * 1024 * 1024)
+
+server = ChapterServer(positional[0], address, cache_size)
+print "Serving %s at http://%s:%d/; press Ctrl-C to stop" % (
+    positional[0], address[0], address[1])
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    print "Stopped serving"
@@ -0,0 +1,47 @@
+# Command-line program which writes statistics on the imported logs as CSV and
+# JSON. Needs NumPy.
+import sys
+import time
+import log_conversion
+from analytics import Corpus
+from clint import args
+
+usage = """
+Reads every chapter from input_path, a directory of JSON files or an archive
+written by import.py --archive, and writes to output_dir:
+
+chapters.csv         each chapter in order: entries of each type, emotes per
+                     statement, words, and how many players spoke
+players.csv          each player: chapters spoken in, statements and words
+player_chapters.csv  each player's statements and words in each chapter
+stats.json           all of the above, plus totals for the whole corpus
+
+Words and lengths count only the text outside any markup.
+
+Flags:
+
+-c chapters [optional] Only these chapters: a comma-separated list of chapter
+names, numbers, and ranges of numbers, as for export.py -c.
+
+Usage: python stats.py input_path output_dir [-c chapters]
+"""
+
+groups = dict(args.grouped)
+positional = groups["_"].all if groups.has_key("_") else []
+
+if args.get(0) is "--help" or len(positional) < 2:
+    print usage
+    sys.exit()
+
+exporter = log_conversion.LogExporter()
+if groups.has_key("-c"):
+    exporter.select(chapters=groups["-c"][0])
+
+start = time.time()
+corpus = Corpus(positional[0], exporter)
+corpus.write_files(positional[1])
+totals = corpus.totals()
+print "%d chapters, %d players, %d entries, %d words in %.2fs" % (
+    totals["chapters"], totals["players"], totals["entries"], totals["words"],
+    time.time() - start)
+print "Wrote statistics to %s" % positional[1]
@@ -1,25 +1,123 @@
 # As it says. Really bone-stupid template system that's barely good enough for
-# this limited purpose.
+# this limited purpose. Templates look like Django's, but only two kinds of tag
+# are understood:
+#
+#   {{ foo }}                   replaced by replacements["foo"]
+#   {% if foo %}...{% endif %}  kept only if replacements["foo"] is truthy;
+#                               may also contain {% else %}
+#
+# Each template is parsed once into a list of segments, and reparsed only if
+# the file changes.
+import os
+import re
+import codecs
 
-def render(template_filename, replacements):
-    """Return a list of lines built by reading the template file and, wherever
-    the pattern '{{ foo }}' is found, replacing it with replacements['foo'].
-    Where the replacement is None, substitutes an empty string."""
-
-    # I can already see the weakness of this approach: if there is no Previous,
-    # for instance, we don't want a line at all. Guess we should just drop in an
-    # actual templating system; the Django one might do as well as any other.
-    input_file = file(template_filename)
-    result = []
-
-    for line in input_file:
-        if "{{ " in line:
-            for key, value in replacements.items():
-                tag = "{{ %s }}" % key
-                if tag in line:
-                    result.append(line.replace(tag, value or ""))
+tag_pattern = re.compile(r"\{\{\s*(\w+)\s*\}\}|\{%\s*(\w+)\s*(\w*)\s*%\}")
+
+# compiled templates by filename: (mtime, segments)
+_cache = {}
+
+
+class TemplateError(Exception):
+    pass
+
+
+def compile_template(text, template_filename="<string>"):
+    """Parse template text into a list of segments. Each segment is a string
+    (static text), a ("var", name) tuple, or an ("if", name, segments,
+    else_segments) tuple."""
+    root = []
+    stack = [("root", root)]  # open blocks, innermost last
+    position = 0
+
+    for match in tag_pattern.finditer(text):
+        if match.start() > position:
+            stack[-1][1].append(text[position:match.start()])
+        position = match.end()
+
+        variable, keyword, argument = match.groups()
+        if variable is not None:
+            stack[-1][1].append(("var", variable))
+        elif keyword == "if" and argument:
+            block = ("if", argument, [], [])
+            stack[-1][1].append(block)
+            stack.append(("if", block[2]))
+        elif keyword == "else" and stack[-1][0] == "if":
+            stack.pop()
+            # the if block is still the last segment of the enclosing block
+            stack.append(("else", stack[-1][1][-1][3]))
+        elif keyword == "endif" and stack[-1][0] in ("if", "else"):
+            stack.pop()
+        else:
+            raise TemplateError("%s: unexpected tag %s" % (template_filename,
+                                                           match.group(0)))
+
+    if len(stack) > 1:
+        raise TemplateError("%s: unclosed {%% if %%}" % template_filename)
+    if position < len(text):
+        root.append(text[position:])
+    return root
+
+
+def load(template_filename):
+    """Return the compiled segments for template_filename, from the cache if
+    the file hasn't changed since it was last compiled."""
+    mtime = os.stat(template_filename).st_mtime
+    cached = _cache.get(template_filename)
+    if cached is None or cached[0] != mtime:
+        input_file = codecs.open(template_filename, encoding="utf-8")
+        cached = (mtime, compile_template(input_file.read(), template_filename))
+        input_file.close()
+        _cache[template_filename] = cached
+    return cached[1]
+
+
+def iter_segments(segments, replacements):
+    """Generate the rendered text of segments, piece by piece. A replacement
+    may be a string, None (rendered as nothing), or any iterable of strings,
+    which is consumed as it is rendered."""
+    for segment in segments:
+        if isinstance(segment, basestring):
+            yield segment
+        elif segment[0] == "var":
+            value = replacements.get(segment[1])
+            if value is None:
+                continue
+            elif isinstance(value, basestring):
+                yield value
+            else:
+                for piece in value:
+                    yield piece
+        elif replacements.get(segment[1]):
+            for piece in iter_segments(segment[2], replacements):
+                yield piece
         else:
-            result.append(line)
+            for piece in iter_segments(segment[3], replacements):
+                yield piece
+
+
+def render(template_filename, replacements):
+    """Return a list of strings built from the template file: wherever the
+    pattern '{{ foo }}' is found, it is replaced with replacements['foo'].
+    Where the replacement is None or missing, substitutes an empty string."""
+    return list(iter_segments(load(template_filename), replacements))
+
+
+def render_to(output_file, template_filename, replacements):
+    """Like render, but writes each piece straight to output_file."""
+    for piece in iter_segments(load(template_filename), replacements):
+        output_file.write(piece)
+
 
-    input_file.close()
-    return result
+def render_around(template_filename, replacements, name):
+    """Render the template, except for the variable name, and return the text
+    before and after it, for the caller to write what goes between. name must
+    be rendered exactly once."""
+    marker = u"\0%s\0" % name
+    replacements = dict(replacements)
+    replacements[name] = marker
+    pieces = u"".join(render(template_filename, replacements)).split(marker)
+    if len(pieces) != 2:
+        raise TemplateError("%s: {{ %s }} is rendered %d times, not once"
+                            % (template_filename, name, len(pieces) - 1))
+    return tuple(pieces)
@@ -0,0 +1,42 @@
+# Command-line program which follows the logs of a session in progress,
+# keeping their JSON, and optionally HTML, up to date as lines are added.
+import sys
+from log_watcher import LogWatcher
+from clint import args
+
+usage = """
+Watches the OpenRPG logs in input_dir. Whenever one grows, its new lines are
+parsed and appended to the chapter's JSON Lines file in json_dir, and, if
+html_dir is given, the chapter's page is rendered again. Only the new lines are
+read, so an update costs the same however long the log or archive gets.
+
+Flags:
+
+--html html_dir [optional] Keep an HTML export in html_dir up to date, as
+export.py -f html -u would.
+
+-n seconds [optional] How often to look for new lines. Defaults to 2.
+
+--once [optional] Update once and exit, instead of watching.
+
+Usage: python watch.py input_dir json_dir [--html html_dir] [-n seconds]
+                                          [--once]
+"""
+
+groups = dict(args.grouped)
+positional = groups["_"].all
+
+if args.get(0) is "--help" or len(positional) != 2:
+    print usage
+    sys.exit()
+
+input_dir, json_dir = positional
+watcher = LogWatcher(input_dir, json_dir,
+                     groups["--html"][0] if groups.has_key("--html") else None)
+if groups.has_key("-n"):
+    watcher.poll_interval = float(groups["-n"][0])
+
+if groups.has_key("--once"):
+    watcher.update()
+else:
+    watcher.watch()